@@ -0,0 +1,510 @@
+"""
+
+    Benchmarks for xlmodel on synthetic models.
+
+    Call example:
+        python bench_xlmodel.py
+        python bench_xlmodel.py suite --sizes small medium -o bench.json
+        python bench_xlmodel.py suite -o new.json --compare bench.json
+
+"""
+
+import argparse
+import contextlib
+import datetime
+import functools
+import io
+import json
+import os
+import platform
+import re
+import subprocess
+import sys
+import shutil
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+import xlrd
+
+from xlmodel import Formula, FormulaTemplate, ExcelSheet, MathModel, Equations, Dataset, SheetLayout
+from xlmodel import WRITER_BACKENDS, SheetWriter, _has_module, get_array_from_sheet, get_cells_from_sheet
+from xlmodel import ModelSnapshot
+
+
+def make_equations(n_vars):
+    """Return equations and var_to_rows for a chain of n_vars dependent variables with controls."""
+    equations = []
+    var_to_rows = {'is_forecast': 2}
+    for i in range(n_vars):
+        var_to_rows['var%d' % i] = 3 + i
+        var_to_rows['rog%d' % i] = 3 + n_vars + i
+        rhs = 'var%d[t-1] * rog%d' % (i, i)
+        if i > 0:
+            rhs += ' + 0.5 * var%d' % (i - 1)
+        equations.append(rhs)
+    return equations, var_to_rows
+
+
+def make_workbook(path, n_vars, n_periods, n_forecast=None):
+    """Write .xls file with model from make_equations() on first sheet, requires xlwt."""
+    import xlwt
+    if n_forecast is None:
+        n_forecast = n_periods // 2
+    equations, var_to_rows = make_equations(n_vars)
+    wb = xlwt.Workbook()
+    ws = wb.add_sheet('model')
+    for t in range(n_periods):
+        ws.write(0, 1 + t, 2000 + t)
+        ws.write(1, 1 + t, int(t >= n_periods - n_forecast))
+    for name, row in var_to_rows.items():
+        ws.write(row - 1, 0, name)
+        for t in range(n_periods):
+            if name.startswith('var') and t < n_periods - n_forecast:
+                ws.write(row - 1, 1 + t, 100.0 + t)
+            elif name.startswith('rog') and t >= n_periods - n_forecast:
+                ws.write(row - 1, 1 + t, 1.05)
+    last_row = max(var_to_rows.values())
+    for i, rhs in enumerate(equations):
+        ws.write(last_row + 1 + i, 0, 'var%d = %s' % (i, rhs))
+    wb.add_sheet('notes').write(0, 0, 'keep')
+    wb.save(path)
+    return path
+
+def timed(func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    return time.perf_counter() - start, result
+
+
+def traced(func, *args):
+    """Return peak memory allocated in bytes while running func(*args)."""
+    tracemalloc.start()
+    try:
+        func(*args)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def formulas_by_formula(equations, var_to_rows, periods):
+    # path before FormulaTemplate: new Formula for each (variable, period) pair
+    return [Formula(eq, var_to_rows).get_xl_formula(p) for eq in equations for p in periods]
+
+
+def formulas_by_template(equations, var_to_rows, periods):
+    result = []
+    for eq in equations:
+        template = FormulaTemplate(eq, var_to_rows)
+        result.extend(template.get_xl_formula(p) for p in periods)
+    return result
+
+
+def bench_formula_generation(n_vars=100, n_periods=50):
+    equations, var_to_rows = make_equations(n_vars)
+    periods = range(2, n_periods + 2)
+    t_formula, ref = timed(formulas_by_formula, equations, var_to_rows, periods)
+    t_template, res = timed(formulas_by_template, equations, var_to_rows, periods)
+    assert res == ref
+    print("Formula generation, %d variables x %d periods:" % (n_vars, n_periods))
+    print("    Formula         %8.3f s" % t_formula)
+    print("    FormulaTemplate %8.3f s" % t_template)
+    print("    speedup         %8.1f x" % (t_formula / t_template))
+
+
+
+def expand_shorthand_by_regex(text, var_to_rows):
+    # shorthand expansion before single-pass tokenizer: one re.sub per variable
+    for var in [v for v in var_to_rows.keys() if v]:
+        rx = var + r'(?!\s*[\dA-Za-z_^\[])'
+        text = re.sub(rx, var + '[t]', text)
+    return text
+
+
+def bench_load(sizes=(100, 500, 1000, 2000, 5000), n_periods=20, regex_limit=100):
+    """Time MathModel construction, which tokenizes every equation; should grow linearly with equation text."""
+    print("MathModel load, %d periods:" % n_periods)
+    for n_vars in sizes:
+        dataset, equations, var_to_rows = make_dataset(n_vars, n_periods)
+        t, model = timed(MathModel, dataset, equations)
+        line = "    %5d variables %8.3f s, %6.2f us per equation character" % (
+            n_vars, t, 1e6 * t / sum(len(eq) for eq in equations))
+        if n_vars <= regex_limit:
+            t_regex, _ = timed(lambda: [expand_shorthand_by_regex(eq, var_to_rows) for eq in equations])
+            line += ", regex expansion alone %8.3f s" % t_regex
+        print(line)
+
+
+def make_dataset(n_vars, n_periods, n_forecast=None):
+    """Return dataframe and equations for model from make_equations(), same as in make_workbook()."""
+    import pandas as pd
+    if n_forecast is None:
+        n_forecast = n_periods // 2
+    rhs_list, var_to_rows = make_equations(n_vars)
+    is_forecast = [int(t >= n_periods - n_forecast) for t in range(n_periods)]
+    data = {'is_forecast': is_forecast}
+    for i in range(n_vars):
+        data['var%d' % i] = [100.0 + t if not f else np.nan for t, f in enumerate(is_forecast)]
+        data['rog%d' % i] = [1.05 if f else np.nan for f in is_forecast]
+    equations = ['var%d = %s' % (i, rhs) for i, rhs in enumerate(rhs_list)]
+    return pd.DataFrame(data, index=range(2000, 2000 + n_periods)), equations, var_to_rows
+
+
+def bench_evaluate(n_vars=200, n_periods=100):
+    dataset, equations, var_to_rows = make_dataset(n_vars, n_periods)
+    model = MathModel(dataset, equations)
+    t_first, _ = timed(model.evaluate)
+    t_repeat, _ = timed(model.evaluate)
+    print("MathModel.evaluate(), %d variables x %d periods:" % (n_vars, n_periods))
+    print("    first call      %8.3f s" % t_first)
+    print("    compiled        %8.3f s" % t_repeat)
+
+
+def bench_sweep(n_scenarios=10000, n_vars=20, n_periods=100):
+    dataset, equations, var_to_rows = make_dataset(n_vars, n_periods)
+    model = MathModel(dataset, equations)
+    rog = 1 + np.random.RandomState(0).uniform(0, 0.1, (n_scenarios, n_periods))
+    t, result = timed(model.sweep, {'rog0': rog})
+    print("MathModel.sweep(), %d scenarios, %d variables x %d periods:" % (n_scenarios, n_vars, n_periods))
+    print("    sweep           %8.3f s" % t)
+
+
+def bench_parallel_formulas(n_vars=20000, n_periods=40, processes=None, chunk_size=2000):
+    """Time MathModel.get_xl_formulas() serially and in pools of 2, 4, ... processes up to cpu count."""
+    dataset, equations, var_to_rows = make_dataset(n_vars, n_periods)
+    if processes is None:
+        processes = [p for p in [2, 4, 8, 16, 32] if p <= max(os.cpu_count() or 1, 2)]
+    print("MathModel.get_xl_formulas(), %d variables x %d periods, %s cores:" % (n_vars, n_periods, os.cpu_count()))
+    model = MathModel(dataset, equations).set_xl_positioning(var_to_rows)
+    t_serial, _ = timed(model.get_xl_formulas)
+    reference = model.data.formulas.copy()
+    print("    serial          %8.3f s" % t_serial)
+    for n in processes:
+        model = MathModel(dataset, equations).set_xl_positioning(var_to_rows)
+        t, _ = timed(model.get_xl_formulas, None, n, chunk_size)
+        assert (model.data.formulas == reference).all()
+        print("    %2d processes    %8.3f s  %5.2f x serial" % (n, t, t_serial / t))
+        
+
+# median time of 'python xlmodel.py --help' should stay below this, 0.59 s before lazy imports 
+STARTUP_TARGET_SECONDS = 0.3
+
+
+def measure_startup(args=('--help',), repeat=7):
+    """Return median wall time of running xlmodel.py with *args* in new interpreter."""
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'xlmodel.py')
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, script] + list(args), stdout=subprocess.DEVNULL, check=True)
+        times.append(time.perf_counter() - start)
+    return sorted(times)[len(times) // 2]
+
+
+def bench_startup():
+    t = measure_startup()
+    print("Command line startup, xlmodel.py --help:")
+    print("    median          %8.3f s, target %.3f s %s" % (t, STARTUP_TARGET_SECONDS, 
+                                                          'ok' if t <= STARTUP_TARGET_SECONDS else 'MISSED'))
+
+
+def get_array_from_sheet_by_cell(filename, sheet):
+    # reader before bulk reads: whole file in memory, per-cell loop
+    book = xlrd.open_workbook(file_contents=open(filename, 'rb').read())
+    sheet = book.sheet_by_index(sheet - 1)
+    array = np.empty((sheet.nrows, sheet.ncols), dtype=object)
+    for row in range(sheet.nrows):
+        for col in range(sheet.ncols):
+            value = sheet.cell(row, col).value
+            if isinstance(value, float) and round(value) == value:
+                value = int(value)
+            array[row][col] = value
+    return array
+
+
+def bench_read(n_vars=165, n_periods=100):
+    tmpdir = tempfile.mkdtemp()
+    try:
+        path = make_workbook(os.path.join(tmpdir, 'source.xls'), n_vars, n_periods)
+        shape = get_array_from_sheet(path, 1).shape
+        print("Sheet reading, %d x %d = %d cells:" % (shape[0], shape[1], shape[0] * shape[1]))
+        for label, func in [('per cell', get_array_from_sheet_by_cell), 
+                            ('bulk', get_array_from_sheet)]:
+            t, _ = timed(func, path, 1)
+            peak = traced(func, path, 1)
+            print("    %-15s %8.3f s %8.1f MB peak" % (label, t, peak / 2**20))
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def bench_snapshot(n_vars=2000, n_periods=50):
+    """Time to get model by parsing workbook and by loading snapshot of parsed model."""
+    tmpdir = tempfile.mkdtemp()
+    try:
+        path = write_xls(os.path.join(tmpdir, 'model.xls'), make_sheet_array(n_vars, n_periods))
+        snapshot_path = os.path.join(tmpdir, 'model.xlsnap')
+        def parse():
+            with contextlib.redirect_stdout(io.StringIO()):
+                return ExcelSheet(path, 1, 'A1', cache=None)
+        parse().save_snapshot(snapshot_path)
+        print("Model from, %d variables x %d periods:" % (n_vars, n_periods))
+        print("    %-15s %8.3f s" % ('workbook', timed(parse)[0]))
+        print("    %-15s %8.3f s %8.1f KB file" % ('snapshot', timed(ModelSnapshot.load, snapshot_path)[0], 
+                                                   os.path.getsize(snapshot_path) / 2**10))
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def bench_write(n_vars=100, n_periods=50):
+    tmpdir = tempfile.mkdtemp()
+    try:
+        source = make_workbook(os.path.join(tmpdir, 'source.xls'), n_vars, n_periods)
+        print("ExcelSheet.save(), %d variables x %d periods:" % (n_vars, n_periods))
+        for backend in WRITER_BACKENDS[1:]:
+            if backend == 'xlwings' and not _has_module('xlwings'):
+                print("    %-15s  skipped, xlwings not available" % backend)
+                continue
+            for full in (True, False):
+                path = shutil.copy(source, os.path.join(tmpdir, backend + '.xls'))
+                xl = ExcelSheet(path)
+                t, _ = timed(functools.partial(xl.save, backend=backend, full=full))
+                label = backend + (', full' if full else ', changed')
+                print("    %-15s %8.3f s" % (label, t))
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+#----------------------------------------------------------------------------------
+#
+#    Phase benchmark suite
+#
+#----------------------------------------------------------------------------------
+
+SIZES = {
+    'small':  dict(n_vars=20,   n_periods=20),
+    'medium': dict(n_vars=200,  n_periods=50),
+    'large':  dict(n_vars=500,  n_periods=100, lag_depth=3, name_length=16),
+}
+
+PHASES = ['get_array_from_sheet', 'get_cells_from_sheet', 'SheetLayout', 'Dataset.from_array', 'pop_equations', 'Equations', 
+          'get_xl_formulas', 'insert_formulas', 'write']
+
+
+def make_sheet_array(n_vars, n_periods, n_equations=None, lag_depth=1, name_length=8, n_forecast=None):
+    """
+    Return 2D object array of a sheet with synthetic model anchored at A1.
+    
+    n_vars variables, of them n_equations dependent (half by default) and the rest controls.
+    Equation of dependent variable i uses its own values lagged 1..lag_depth periods, 
+    one control and previous dependent variable. Names are padded to name_length characters.
+    """
+    if n_equations is None:
+        n_equations = n_vars // 2
+    if n_forecast is None:
+        n_forecast = n_periods // 2
+    if lag_depth > n_periods - n_forecast:
+        raise ValueError("lag_depth must not exceed number of historic periods")
+    n_controls = max(n_vars - n_equations, 1)
+    dependents = [('y%d_' % i).ljust(name_length, 'x') for i in range(n_equations)]
+    controls = [('c%d_' % i).ljust(name_length, 'x') for i in range(n_controls)]
+    
+    arr = np.full((2 + len(dependents) + len(controls) + n_equations, 1 + n_periods), '', dtype=object)
+    arr[0, 1:] = [2000 + t for t in range(n_periods)]
+    arr[1, 0] = 'is_forecast'
+    arr[1, 1:] = [int(t >= n_periods - n_forecast) for t in range(n_periods)]
+    for i, name in enumerate(dependents + controls):
+        arr[2 + i, 0] = name
+        for t in range(n_periods):
+            if t < n_periods - n_forecast and name in dependents:
+                arr[2 + i, 1 + t] = 100.0 + t
+            elif t >= n_periods - n_forecast and name in controls:
+                arr[2 + i, 1 + t] = 1.01
+    for i, name in enumerate(dependents):
+        lags = ' + '.join('%s[t-%d]' % (name, k) for k in range(1, lag_depth + 1))
+        rhs = '(%s) / %d * %s' % (lags, lag_depth, controls[i % n_controls])
+        if i > 0:
+            rhs += ' + 0.5 * ' + dependents[i - 1]
+        arr[2 + len(dependents) + len(controls) + i, 0] = '%s = %s' % (name, rhs)
+    return arr
+
+
+def write_xls(path, arr):
+    """Write 2D array to first sheet of new .xls file, requires xlwt."""
+    import xlwt
+    wb = xlwt.Workbook()
+    ws = wb.add_sheet('model')
+    for (rowx, colx), value in np.ndenumerate(arr):
+        if value != '':
+            ws.write(rowx, colx, value)
+    wb.save(path)
+    return path
+
+
+class MemoryWriter(SheetWriter):
+    """Writer stand-in keeping written cells in a dictionary, used to time writing without file input/output."""
+    
+    def __init__(self, filepath=None):
+        self.filepath = filepath
+        self.cells = {}
+        
+    def write_range(self, sheet, rowx, colx, values):
+        for i, row in enumerate(values):
+            for j, value in enumerate(row):
+                self.cells[sheet, rowx + i, colx + j] = self._cell_value(value)
+                
+    def save(self):
+        pass
+
+
+class NullWriter(SheetWriter):
+    """Writer stand-in counting written cells, used to measure memory of formula generation and writing."""
+    
+    def __init__(self, filepath=None):
+        self.filepath = filepath
+        self.n_cells = 0
+        
+    def write_range(self, sheet, rowx, colx, values):
+        self.n_cells += sum(len(row) for row in values)
+                
+    def save(self):
+        pass
+
+
+def bench_streaming(n_vars=200, n_periods=5000, chunk_sizes=(1, 100)):
+    """Peak memory of generating and writing formulas at once and streamed by chunks of forecast periods."""
+    arr = make_sheet_array(n_vars, n_periods)
+    
+    def make_write(chunk_size):
+        # sheet without formulas, its write() generates them at once or by chunks 
+        with contextlib.redirect_stdout(io.StringIO()):
+            sheet = ExcelSheet('model.xls', 1, 'A1', arr=arr, chunk_size=chunk_size or 1)
+        sheet.chunk_size = chunk_size
+        def write():
+            if chunk_size is None:
+                sheet.insert_formulas()
+            sheet.write(NullWriter(), 1)
+        return write
+        
+    print("Formulas written to sheet, %d variables x %d periods:" % (n_vars, n_periods))
+    for chunk_size in (None,) + tuple(chunk_sizes):
+        label = "at once" if chunk_size is None else "%d per chunk" % chunk_size
+        t = timed(make_write(chunk_size))[0]
+        print("    %-15s %8.3f s %8.1f MB peak" % (label, t, traced(make_write(chunk_size)) / 2**20))
+
+
+def best_of(func, repeat):
+    """Return minimum time of *repeat* calls of func()."""
+    return min(timed(func)[0] for _ in range(repeat))
+
+
+def bench_phases(n_vars, n_periods, repeat=3, **model_kwargs):
+    """Return dictionary of phase name to seconds for synthetic model of given size."""
+    arr = make_sheet_array(n_vars, n_periods, **model_kwargs)
+    tmpdir = tempfile.mkdtemp()
+    try:
+        path = write_xls(os.path.join(tmpdir, 'model.xls'), arr)
+        arr = get_array_from_sheet(path, 1)
+        
+        # ExcelSheet instance without reading file, its parse steps are timed separately  
+        xl = ExcelSheet.__new__(ExcelSheet)
+        xl.arr = arr
+        data = Dataset.from_array(arr, 0, 0)
+        def pop_equations():
+            xl.data = data
+            return xl.pop_equations()
+        equation_strings = pop_equations()
+        equations = Equations(equation_strings).dict
+        var_to_rows = {label: rowx + 1 for rowx, label in enumerate(arr[:, 0]) if label in xl.data.index}
+        model = MathModel(xl.data, equation_strings).set_xl_positioning(var_to_rows, 'A1')
+        
+        with contextlib.redirect_stdout(io.StringIO()):
+            sheet = ExcelSheet(path, 1, 'A1', arr=arr.copy())
+        
+        phases = {
+            'get_array_from_sheet': lambda: get_array_from_sheet(path, 1),
+            'get_cells_from_sheet': lambda: get_cells_from_sheet(path, 1, 'A1'),
+            'SheetLayout': lambda: SheetLayout(arr, ['A1']),
+            'Dataset.from_array': lambda: Dataset.from_array(arr, 0, 0),
+            'pop_equations': pop_equations,
+            'Equations': lambda: Equations(equation_strings),
+            'get_xl_formulas': model.get_xl_formulas,
+            'insert_formulas': sheet.insert_formulas,
+            'write': lambda: sheet.write(MemoryWriter(), 1, full=True),
+        }
+        assert len(equations) == len(model.order)
+        return {name: best_of(phases[name], repeat) for name in PHASES}
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], stderr=subprocess.DEVNULL, 
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_suite(sizes=('small', 'medium'), repeat=3):
+    """Return JSON-serialisable dictionary with phase timings for each size in *sizes*."""
+    results = [{'size': 'cli', 'params': {'target': STARTUP_TARGET_SECONDS}, 
+                'phase': 'startup', 'seconds': measure_startup()}]
+    for size in sizes:
+        params = SIZES[size]
+        for phase, seconds in bench_phases(repeat=repeat, **params).items():
+            results.append({'size': size, 'params': params, 'phase': phase, 'seconds': seconds})
+    return {'commit': git_commit(), 
+            'date': datetime.datetime.now().isoformat(timespec='seconds'),
+            'python': platform.python_version(), 
+            'repeat': repeat,
+            'results': results}
+
+
+def print_suite(report, baseline=None):
+    base = {}
+    if baseline:
+        base = {(r['size'], r['phase']): r['seconds'] for r in baseline['results']}
+        print("Baseline commit %s, current commit %s" % (baseline.get('commit'), report.get('commit')))
+    for r in report['results']:
+        line = "    %-7s %-22s %8.4f s" % (r['size'], r['phase'], r['seconds'])
+        key = (r['size'], r['phase'])
+        if key in base:
+            line += "  %6.2f x baseline" % (r['seconds'] / base[key])
+        print(line)
+
+
+def suite_cli(argv=None):
+    parser = argparse.ArgumentParser(prog='bench_xlmodel.py suite', 
+                                     description='Time read, parse, generate and write phases on synthetic models')
+    parser.add_argument('--sizes', nargs='+', default=['small', 'medium'], choices=sorted(SIZES))
+    parser.add_argument('--repeat', type=int, default=3, help='best of this many runs is reported')
+    parser.add_argument('-o', '--output', help='JSON file to store results')
+    parser.add_argument('--compare', help='JSON file with results of earlier run')
+    args = parser.parse_args(argv)
+    
+    report = run_suite(args.sizes, args.repeat)
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    print_suite(report, baseline)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    if sys.argv[1:2] == ['suite']:
+        suite_cli(sys.argv[2:])
+    else:
+        bench_startup()
+        bench_formula_generation()
+        bench_parallel_formulas()
+        bench_streaming()
+        bench_load()
+        bench_evaluate()
+        bench_sweep()
+        bench_read()
+        bench_snapshot()
+        bench_write()
@@ -1,11 +1,22 @@
 import os
+import shutil
+import subprocess
+import sys
+import pytest
 import pandas as pd
 import numpy as np
 
 from xlmodel import col_to_num, to_xl_ref, to_rowcol
-from xlmodel import FormulaSegment, Formula, MathModel  
-from xlmodel import ExcelSheet, _get_xlrd_sheet
+from xlmodel import FormulaSegment, Formula, MathModel, Dataset  
+from xlmodel import FormulaTemplate, parse_time_index, tokenize_equation
+from xlmodel import ExcelSheet, ExcelBook, _get_xlrd_sheet
 from xlmodel import is_equal
+from xlmodel import r1c1_to_a1, get_writer, get_array_from_sheet
+from xlmodel import get_changed_ranges
+from xlmodel import run_batch, read_manifest, batch_cli
+from xlmodel import FormulaCache, Watcher, Profiler, SheetLayout, FormulaService
+from xlmodel import CellStore, get_cells_from_sheet, BlockAssembler, write_workbook
+from xlmodel import ModelSnapshot
 
 # test data     
 COLUMNS = ['is_forecast', 'y', 'rog']   
@@ -14,12 +25,15 @@ DF =  pd.DataFrame({  'y' : [    85,    100, np.nan],
                     'rog' : [np.nan, np.nan,   1.05],
             'is_forecast' : [     0,      0,      1]},
                     index = [  2014,   2015,   2016])[COLUMNS]   
-assert is_equal(DF, pd.read_excel('test1.xls').transpose()[COLUMNS])
+assert is_equal(DF, pd.read_excel('test1.xls', index_col=0).transpose()[COLUMNS])
 EQS = ['y = y[t-1] * rog'] 
 REF_DF = DF.copy()
 REF_DF.loc[2016,'y'] = '=C3*D4'
 
 PATH = "test1.xls"
+
+# .xls fixtures are written without Excel on purpose
+pytestmark = pytest.mark.filterwarnings("ignore:Writing .xls without Excel")
 SHEET_NAME = 'input_sheet_v1'
 
  
@@ -35,6 +49,11 @@ def test_basefunc():
     assert to_rowcol("AA1") == (1, 27)
 
 
+def test_lazy_imports():
+    # core and command line help do not load pandas or Excel backends
+    code = "import sys, xlmodel; print(sorted(m for m in ['pandas', 'xlrd', 'xlwings', 'openpyxl'] if m in sys.modules))"
+    assert subprocess.check_output([sys.executable, '-c', code]).decode().strip() == '[]'
+    
 def test_segment():
     # segment contains varname and time period  
     # test segment "GDP[1]" conversion to 'D5' 
@@ -58,6 +77,47 @@ def test_formula():
     # same start of variable name
     assert 'FondOT[t]+FondOther[t]' == Formula.expand_shorthand("FondOT+FondOther", {"FondOT":0,"FondOther":1})
     
+def test_time_index():
+    assert parse_time_index('t') == (True, 0)
+    assert parse_time_index('t-1') == (True, -1)
+    assert parse_time_index('t+2') == (True, 2)
+    assert parse_time_index('5') == (False, 5)
+    for bad in ['', 't+t', '2t', 't-', 't--1', 't1']:
+        with pytest.raises(ValueError):
+            parse_time_index(bad)
+    
+def test_tokenize_equation():
+    var_to_rows = {'GDP': 1, 'GDP2': 2, 'P': 3, 'e5': 4, 'rog': 5}
+    # names that are prefixes or suffixes of other names, power operator, numbers and functions
+    text, parts, refs = tokenize_equation('GDP[t-1] + GDP2*P^2 + 1e5 * MAX(rog, 1)', var_to_rows)
+    assert text == 'GDP[t-1]+GDP2[t]*P[t]^2+1e5*MAX(rog[t],1)'
+    assert parts == ['', '+', '*', '^2+1e5*MAX(', ',1)']
+    assert refs == [('GDP', True, -1), ('GDP2', True, 0), ('P', True, 0), ('rog', True, 0)]
+    with pytest.raises(ValueError):
+        tokenize_equation('GDP[x]', var_to_rows)
+    
+def test_formula_template():
+    # compiled template renders same formulas as Formula 
+    var_to_rows = {'GDP': 5, 'rog': 6, 'x': 7}
+    for eq in ['GDP[t-1] * rog', 'GDP * rog + x[t-2] - x[2]', '(GDP[t-1]+rog[t+1])/2']:
+        template = FormulaTemplate(eq, var_to_rows, anchor="C2")
+        for period in range(3, 6):
+            assert template.get_xl_formula(period) == \
+                   Formula(eq, var_to_rows, "C2").get_xl_formula(period)
+    with pytest.raises(KeyError):
+        FormulaTemplate('y[t-1] * rog', {'rog': 4})
+
+def test_r1c1():
+    template = FormulaTemplate('y[t-1] * rog + x[2]', {'y': 3, 'rog': 4, 'x': 5}, anchor="B1")
+    assert template.get_r1c1_formula(row=3) == '=RC[-1]*R[1]C+R[2]C4'
+    m = MathModel(equations = EQS, dataset = DF).set_xl_positioning(var_to_rows = VAR_TO_ROWS)
+    assert m.get_r1c1_ranges() == [(3, 4, 4, '=RC[-1]*R[1]C')]
+    # variable without row on sheet is skipped, same as in get_xl_formulas()
+    m = MathModel(equations = EQS + ['z = y * 2'], dataset = DF).set_xl_positioning(var_to_rows = VAR_TO_ROWS)
+    assert m.get_xl_formulas() == ['y']
+    assert m.get_r1c1_ranges() == [(3, 4, 4, '=RC[-1]*R[1]C')]
+    assert r1c1_to_a1('=RC[-1]*R[1]C+R[2]C4', row=3, col=4) == '=C3*D4+D5'
+        
     
 def test_math_model():
     # model with no Excel, local variables only
@@ -65,6 +125,162 @@ def test_math_model():
     m.set_xl_positioning(var_to_rows = VAR_TO_ROWS)
     assert is_equal(m.get_xl_dataset(), REF_DF)
     
+def test_parallel_formulas():
+    # chain of 50 variables, formulas from pool of processes are same as in serial run
+    n = 50
+    labels = ['is_forecast', 'x0'] + ['x%d' % i for i in range(1, n)]
+    values = np.full((len(labels), 6), '', dtype=object)
+    values[0] = [0, 0, 1, 1, 0, 1]
+    equations = ['x%d = x%d[t-1] * 2 + x%d' % (i, i, i - 1) for i in range(1, n)]
+    var_to_rows = dict((label, i + 2) for i, label in enumerate(labels))
+    models = [MathModel(Dataset(labels, range(2010, 2016), values), equations).set_xl_positioning(var_to_rows, "B2")
+              for _ in range(2)]
+    assert models[0].get_xl_formulas() == models[1].get_xl_formulas(processes=2, chunk_size=7)
+    assert (models[0].data.formulas == models[1].data.formulas).all()
+    assert models[1].data.formulas[5, 5] == '=G7*2+H6'
+    
+def test_streamed_formulas(tmp_path):
+    # formulas generated chunk by chunk of forecast periods are same as formulas filled at once
+    path = os.path.join('examples', 'bank.xls')
+    sh = ExcelSheet(path, 1, "C1")
+    streamed = ExcelSheet(path, 1, "C1", chunk_size=2)
+    assert (streamed.model.data.formulas == None).all()
+    assert get_changed_ranges(streamed.source_arr, streamed.arr) == []
+    chunks = list(streamed.model.iter_xl_formulas(chunk_size=2))
+    assert [len(positions) for positions, varnames, rows in chunks] == [2, 2, 2]
+    cells = {}
+    for rowx, colx, values in streamed.iter_formula_ranges():
+        for i, row in enumerate(values):
+            for j, formula in enumerate(row):
+                cells[rowx + i, colx + j] = formula
+    assert sorted(cells.items()) == sorted(((rowx, colx), f) for rowx, colx, f in sh.get_formula_cells())
+    # same file written
+    for chunk_size in [None, 4]:
+        path = make_xlsx(str(tmp_path / ("%s.xlsx" % chunk_size)), [get_array_from_sheet(PATH, 1)])
+        ExcelSheet(path, 1, "A1", chunk_size=chunk_size).save(backend='file')
+        assert pytest.importorskip('openpyxl').load_workbook(path).active['D3'].value == '=C3*D4'
+    
+def test_model_snapshot(tmp_path):
+    # parsed sheet comes back from snapshot with same dataset, equations and formulas
+    path = str(tmp_path / 'bank.xls')
+    shutil.copy(os.path.join('examples', 'bank.xls'), path)
+    sh = ExcelSheet(path, 1, "C1")
+    snapshot_path = str(tmp_path / 'bank.xlsnap')
+    sh.save_snapshot(snapshot_path)
+    snapshot = ModelSnapshot.load(snapshot_path)
+    assert snapshot.data.labels == sh.data.labels
+    assert snapshot.data.periods == sh.data.periods
+    assert snapshot.data.values.tolist() == sh.data.values.tolist()
+    assert snapshot.equations == sh.equations
+    assert snapshot.var_to_rows == sh.var_to_rows
+    assert snapshot.source == {'path': os.path.abspath(path), 'sheet': 1}
+    m = MathModel.from_snapshot(snapshot_path)
+    assert m.anchor == "C1"
+    assert m.get_xl_formulas() == sh.model.get_xl_formulas()
+    assert list(m.iter_formula_ranges(4)) == list(sh.iter_formula_ranges(4))
+    # model without sheet, texts and missing values kept
+    data = Dataset.from_dataframe(DF)
+    data.values[1, 0] = 'text'
+    MathModel(data, EQS).set_xl_positioning(VAR_TO_ROWS).save_snapshot(snapshot_path)
+    snapshot = ModelSnapshot.load(snapshot_path, mmap=False)
+    assert is_equal(snapshot.data.to_dataframe(), data.to_dataframe())
+    assert snapshot.get_model().get_xl_formulas() == ['y']
+    with pytest.raises(ValueError):
+        snapshot.write_formulas()
+    # formulas written to workbook without reading it
+    xlsx = make_xlsx(str(tmp_path / 'model.xlsx'), [get_array_from_sheet(PATH, 1)])
+    snapshot.write_formulas(xlsx, 1, backend='file')
+    assert pytest.importorskip('openpyxl').load_workbook(xlsx).active['D3'].value == '=C3*D4'
+    with pytest.raises(ValueError):
+        ModelSnapshot.load(xlsx)
+    # command line: export snapshot on normal run, then write formulas from snapshot
+    script = os.path.abspath('xlmodel.py')
+    subprocess.check_output([sys.executable, script, path, '1', 'C1', '--backend', 'file', 
+                             '--save-snapshot', snapshot_path, '--no-cache'])
+    output = subprocess.check_output([sys.executable, script, snapshot_path, '--backend', 'file'])
+    assert 'Formulas from snapshot' in output.decode()
+    # explicit sheet of command line is used, anchor is refused 
+    output = subprocess.check_output([sys.executable, script, snapshot_path, '2', '--backend', 'file'])
+    assert 'Sheet:\n    2' in output.decode().replace('\r', '')
+    assert subprocess.call([sys.executable, script, snapshot_path, '1', 'B3'], stderr=subprocess.DEVNULL) == 2
+    assert ModelSnapshot.load(snapshot_path).equations == sh.equations
+    
+def test_dataset():
+    data = Dataset.from_dataframe(DF)
+    assert data.labels == COLUMNS
+    assert data.periods == [2014, 2015, 2016]
+    assert data.forecast_positions.tolist() == [2]
+    assert is_equal(data.to_dataframe(), DF)
+    assert data.drop(['rog']).labels == ['is_forecast', 'y']
+    # formulas are kept apart from values
+    m = MathModel(data, EQS).set_xl_positioning(VAR_TO_ROWS)
+    assert m.get_xl_formulas() == ['y']
+    assert m.data.formulas[m.data.index['y']].tolist() == [None, None, '=C3*D4']
+    assert is_equal(m.dataset, DF)
+    assert data.formulas[1, 2] is None
+    
+def test_dependency_graph():
+    eqs = ['c = a + b', 'a = a[t-1] * rog', 'b = a * 2 + c[t-1]']
+    df = pd.DataFrame({'a': [1, None], 'b': [1, None], 'c': [1, None], 'rog': [None, 1.1], 'is_forecast': [0, 1]})
+    m = MathModel(df, eqs).set_xl_positioning({'is_forecast': 2, 'a': 3, 'b': 4, 'c': 5, 'rog': 6})
+    assert m.order == ['a', 'b', 'c']
+    assert m.references['b'] == {'a', 'c'}
+    # only changed equation and equations using moved row are regenerated 
+    assert m.update(equations = ['c = a + b', 'a = a[t-1] * rog', 'b = a * 3 + c[t-1]']) == ['b']
+    assert m.update(var_to_rows = {'is_forecast': 2, 'a': 3, 'b': 4, 'c': 5, 'rog': 7}) == ['a']
+    # variable without equation anymore is returned as well
+    assert m.update(equations = ['c = a + b', 'a = a[t-1] * rog']) == ['b']
+    with pytest.raises(ValueError):
+        MathModel(df, ['a = b', 'b = c', 'c = a[t-1] + a'])
+    # variable using itself in same period is a circular reference in Excel 
+    with pytest.raises(ValueError, match="a -> a"):
+        MathModel(df, ['a = a * 2'])
+    
+def test_evaluate():
+    m = MathModel(equations = EQS, dataset = DF)
+    assert m.evaluate().loc[2016, 'y'] == 100 * 1.05
+    # no lags of dependent variables - computed for all forecast periods at once
+    m = MathModel(DF, ['y = 2 ^ rog + MAX(rog, 1) - ABS(-1)'])
+    assert m.get_evaluator().vectorized == ['y']
+    assert m.evaluate().loc[2016, 'y'] == 2 ** 1.05 + 1.05 - 1
+    with pytest.raises(ValueError):
+        MathModel(DF, ['y = SUM(rog)']).evaluate()
+    # MAX and MIN of more than two arguments, Excel precedence of unary minus and ^
+    df = pd.DataFrame({'a': [1, 1], 'b': [5, 5], 'c': [9, 9], 'y': [0, None], 'is_forecast': [0, 1]})
+    for equation, value in [('MAX(a[t-1], b[t-1], c[t-1])', 9), ('MIN(c, a, b)', 1), ('-2^2', 4), 
+                            ('-a^2 + 2*-b^2', 51), ('2^a^c', 512), ('-(b-c)^2', 16), ('2^-a', 0.5)]:
+        assert MathModel(df, ['y = ' + equation]).evaluate()['y'].iloc[1] == value
+    with pytest.raises(ValueError):
+        MathModel(df, ['y = (a + b']).evaluate()
+
+def test_sweep():
+    m = MathModel(equations = EQS, dataset = DF)
+    rog = np.array([[np.nan, np.nan, 1.0], [np.nan, np.nan, 1.05], [np.nan, np.nan, 1.1]])
+    result = m.sweep({'rog': rog}, chunk_size = 2)
+    assert result.shape == (3, 1, 3)
+    assert np.allclose(result[:, 0, 2], [100, 105, 110])
+    assert np.allclose(result[:, 0, :2], [85, 100])
+    result = m.sweep({'rog': rog}, varnames = ['y', 'rog'])
+    assert np.allclose(result[:, 1, 2], [1.0, 1.05, 1.1])
+    with pytest.raises(KeyError):
+        m.sweep({'unknown': rog})
+
+def test_evaluate_matches_excel():
+    # forecast values saved by Excel in example file 
+    sh = ExcelSheet(os.path.join('examples', 'bank.xls'), 1, "C1")
+    m = MathModel(sh.dataset, sh.equations)
+    is_forecast = np.asarray(sh.dataset.is_forecast) == 1
+    excel_values = m.get_values()[:, is_forecast]
+    assert np.allclose(m.evaluate().values.T[:, is_forecast], excel_values)
+    
+def test_refresh():
+    sh = ExcelSheet(PATH)
+    arr = sh.source_arr.copy()
+    assert sh.refresh(arr) == []
+    arr[4, 0] = 'y = y[t-1] * rog * 2'
+    assert sh.refresh(arr) == ['y']
+    assert sh.arr[2, 3] == '=C3*D4*2'
+    
 #-------------------
     
 def test_xl_sheet_reading():    
@@ -73,6 +289,13 @@ def test_xl_sheet_reading():
     df2 = ExcelSheet(PATH, sheet=2, anchor="B3").dataset    
     assert is_equal(df2, df1)
 
+def test_array_from_sheet():
+    arr = get_array_from_sheet(PATH, 1)
+    assert arr.shape == (5, 4)
+    assert arr[0].tolist() == ['', 2014, 2015, 2016]
+    assert type(arr[0, 1]) is int
+    assert arr[3, 3] == 1.05
+
 def test_model_on_sheet():
     sh = ExcelSheet(PATH)
     assert is_equal(sh.dataset, DF)
@@ -88,28 +311,407 @@ def read_by_name_and_int():
    
 # ------------------   
    
-def test_xl_sheet_end_to_end():        
-    
-    ExcelSheet(PATH, 1, "A1").save(sheet=3)
-    ExcelSheet(PATH, 2, "B3").save(sheet=4)
+def test_xl_sheet_end_to_end(tmp_path):        
+    path = str(tmp_path / PATH)
+    shutil.copy(PATH, path)
+    ExcelSheet(path, 1, "A1").save(sheet=3, backend='file')
+    ExcelSheet(path, 2, "B3").save(sheet=4, backend='file')
 
-    df3 = ExcelSheet(PATH, sheet=3, anchor="A1").dataset
-    df4 = ExcelSheet(PATH, sheet=4, anchor="B3").dataset  
+    df3 = ExcelSheet(path, sheet=3, anchor="A1").dataset
+    df4 = ExcelSheet(path, sheet=4, anchor="B3").dataset  
     
     assert is_equal(df3, df4)
 
-def run_example(filename, sheet=1, anchor="c1"):
-    ExcelSheet(os.path.join('examples', filename), sheet, anchor).save()#.echo()
+def test_file_writer(tmp_path):
+    # writes without Excel, other sheets are kept
+    path = str(tmp_path / PATH)
+    shutil.copy(PATH, path)
+    ExcelSheet(path, 1, "A1").save(sheet=3, backend='file')
+    arr = get_array_from_sheet(path, 3)
+    assert arr[2, 2] == 100
+    assert arr[4, 0] == EQS[0]
+    assert (get_array_from_sheet(path, 2) == get_array_from_sheet(PATH, 2)).all()
+    
+def test_changed_ranges():
+    old = np.zeros((5, 5), dtype=object)
+    new = old.copy()
+    new[1:3, 2:4] = '=A1'
+    new[3, 2] = 1
+    new[4, 0] = 'x'
+    assert get_changed_ranges(old, old) == []
+    assert get_changed_ranges(old, new) == [(1, 2, [['=A1', '=A1'], ['=A1', '=A1']]),
+                                            (3, 2, [[1]]), 
+                                            (4, 0, [['x']])]
+
+def test_save_changed_cells_only(tmp_path):
+    path = str(tmp_path / PATH)
+    shutil.copy(PATH, path)
+    xl = ExcelSheet(path, 1, "A1")
+    # cell edited after sheet was read is not overwritten
+    writer = get_writer(path, backend='file')
+    writer.write_range(1, 3, 1, [['edited']])
+    writer.save()
+    xl.save(backend='file')
+    assert get_array_from_sheet(path, 1)[3, 1] == 'edited'
+    
+def make_xlsx(path, sheet_values):
+    openpyxl = pytest.importorskip('openpyxl')
+    wb = openpyxl.Workbook()
+    wb.remove(wb.active)
+    for i, arr in enumerate(sheet_values):
+        ws = wb.create_sheet('sheet%d' % (i + 1))
+        for row in arr.tolist():
+            ws.append([None if v == '' else v for v in row])
+    wb.save(path)
+    return path
+    
+def test_xlsx_reading(tmp_path):
+    path = make_xlsx(str(tmp_path / "test1.xlsx"), 
+                     [get_array_from_sheet(PATH, 1), get_array_from_sheet(PATH, 2)])
+    assert (get_array_from_sheet(path, 1) == get_array_from_sheet(PATH, 1)).all()
+    # cells before anchor are not read
+    arr = get_array_from_sheet(path, 'sheet2', anchor="B3")
+    assert arr.shape == (7, 5)
+    assert arr[2:, 1:].tolist() == get_array_from_sheet(PATH, 2)[2:, 1:].tolist()
+    sh = ExcelSheet(path, 2, "B3").save(backend='file')
+    assert is_equal(sh.dataset, DF)
+    assert pytest.importorskip('openpyxl').load_workbook(path)['sheet2']['E5'].value == '=D5*E6'
+    
+def test_xlsx_full_write_keeps_unread_cells(tmp_path):
+    arr = get_array_from_sheet(PATH, 2)
+    arr[0, 0] = 'title'
+    path = make_xlsx(str(tmp_path / "test1.xlsx"), [arr, arr])
+    # cells before anchor are not read, full writes leave them as they are  
+    ExcelSheet(path, 1, "B3").save(backend='file', full=True)
+    ExcelSheet(path, 1, "B3").save(sheet=2, backend='file')
+    wb = pytest.importorskip('openpyxl').load_workbook(path)
+    for ws in wb.worksheets:
+        assert ws['A1'].value == 'title'
+        assert ws['E5'].value == '=D5*E6'
+    
+def test_cell_store():
+    arr = get_array_from_sheet(PATH, 2)
+    cells = CellStore.from_array(arr)
+    assert len(cells) == np.count_nonzero(arr != '')
+    assert cells.shape == arr.shape
+    assert (cells.to_array() == arr).all()
+    assert cells.to_array(2, 1, 4, 3).tolist() == arr[2:4, 1:3].tolist()
+    assert cells[4, 2] == arr[4, 2] and cells[0, 0] == ''
+    assert cells[3, [2, 3]].tolist() == arr[3, [2, 3]].tolist()
+    # same writes as with dense array
+    new, new_arr = cells.copy(), arr.copy()
+    new[4, [3, 4]] = new_arr[4, [3, 4]] = ['=D5*E6', 7]
+    new[5, 1] = new_arr[5, 1] = ''
+    assert get_changed_ranges(cells, new) == get_changed_ranges(arr, new_arr)
+    # ranges hold all cells and nothing else
+    written = np.full(arr.shape, '', dtype=object)
+    for rowx, colx, values in cells.get_ranges():
+        assert '' not in np.ravel(values)
+        written[rowx:rowx + len(values), colx:colx + len(values[0])] = values
+    assert (written == arr).all()
+
+def test_bounded_read(tmp_path):
+    # block at B3 with notes above, to the right and far below it 
+    arr = np.full((40, 30), '', dtype=object)
+    arr[2:7, 1:5] = get_array_from_sheet(PATH, 2)[2:7, 1:5]
+    arr[0, 0] = 'title'
+    arr[4, 20] = 'chart source'
+    arr[39, 29] = 'note'
+    arr[8, 3] = 'unlabelled row'
+    path = make_xlsx(str(tmp_path / "sparse.xlsx"), [arr])
+    cells = get_cells_from_sheet(path, 1, "B3")
+    assert sorted(key for key, value in cells.items()) == \
+           sorted(key for key, value in np.ndenumerate(arr[:, :5]) if value != '' and key[0] >= 2 and key[0] != 8)
+    assert len(get_cells_from_sheet(path, 1)) == np.count_nonzero(arr != '')
+    sh = ExcelSheet(path, 1, "B3")
+    assert is_equal(sh.dataset, DF)
+    assert sh.var_to_rows == {'is_forecast': 4, 'y': 5, 'rog': 6}
+    sh.save(backend='file', full=True)
+    ws = pytest.importorskip('openpyxl').load_workbook(path).active
+    assert [ws['A1'].value, ws['U5'].value, ws['AD40'].value, ws['E5'].value] == ['title', 'chart source', 'note', '=D5*E6']
+    # same block from .xls file
+    cells = get_cells_from_sheet(PATH, 2, "B3")
+    assert (cells.to_array(2, 1) == get_array_from_sheet(PATH, 2)[2:, 1:]).all()
+    
+def test_block_assembler(tmp_path):
+    data = DF.loc[[2014, 2015], ['y']]
+    controls = DF.loc[[2016], ['rog']]
+    cells = BlockAssembler(EQS, data, controls).get_cells()
+    assert cells.to_array().tolist() == [['', 2014, 2015, 2016], 
+                                         ['is_forecast', 0, 0, 1],
+                                         ['# data', '', '', ''],
+                                         ['y', 85, 100, '=C4*D6'],
+                                         ['# controls', '', '', ''],
+                                         ['rog', '', '', 1.05],
+                                         ['# equations', '', '', ''],
+                                         ['y = y[t-1] * rog', '', '', '']]
+    # new workbooks are read back as same model
+    for name in ['model.xls', 'model.xlsx']:
+        path = str(tmp_path / name)
+        BlockAssembler(EQS, data, controls).save(path, 'model', backend='file')
+        sh = ExcelSheet(path, 'model', "A1")
+        assert is_equal(sh.dataset, DF)
+        assert sh.equations == EQS
+        assert sh.arr[3, 3] == '=C4*D6'
+    # blocks of model read from sheet
+    cells = BlockAssembler.from_model(ExcelSheet(PATH).model, "B2").get_cells()
+    assert cells[4, 1] == 'y' and cells[6, 1] == 'rog' and cells[4, 4] == '=D5*E7'
+    write_workbook(str(tmp_path / 'two.xlsx'), {'a': cells.to_array(), 'b': [[1, '=A1*2']]}, backend='file')
+    ws = pytest.importorskip('openpyxl').load_workbook(str(tmp_path / 'two.xlsx'))['b']
+    assert [ws['A1'].value, ws['B1'].value] == [1, '=A1*2']
+    
+def test_excel_book(tmp_path):
+    book = ExcelBook(PATH)
+    assert is_equal(book.sheet(1, "A1").dataset, book.sheet(2, "B3").dataset)
+    # several sheets written in one save 
+    path = make_xlsx(str(tmp_path / "test1.xlsx"), 
+                     [get_array_from_sheet(PATH, 1), get_array_from_sheet(PATH, 2)])
+    book = ExcelBook(path)
+    book.sheet(1, "A1")
+    book.sheet(2, "B3")
+    book.save(backend='file')
+    wb = pytest.importorskip('openpyxl').load_workbook(path)
+    assert wb['sheet1']['D3'].value == '=C3*D4'
+    assert wb['sheet2']['E5'].value == '=D5*E6'
+    
+def test_blocks(tmp_path):
+    # blocks at A1 and A7 and one more at F1 on the right of the first
+    block = get_array_from_sheet(PATH, 1)
+    arr = np.full((11, 9), '', dtype=object)
+    arr[0:5, 0:4] = block
+    arr[6:11, 0:4] = block
+    arr[10, 0] = 'y = y[t-1] * rog * 2'
+    arr[0:5, 5:9] = block
+    layout = SheetLayout(arr)
+    assert layout.get_anchors() == ['A1', 'F1', 'A7']
+    assert layout.get_bounds(0, 0) == (6, 5)
+    assert layout.get_bounds(6, 0) == (11, 5)
+    assert layout.get_labels(6, 0) == {'is_forecast': 7, 'y': 8, 'rog': 9, 'y = y[t-1] * rog * 2': 10}
+    path = make_xlsx(str(tmp_path / "blocks.xlsx"), [arr])
+    profiler = Profiler(memory=False)
+    book = ExcelBook(path, profiler=profiler)
+    assert [xl.var_to_rows['y'] for xl in book.blocks(1)] == [3, 3, 9]
+    book.sheet(1, "F1")
+    # sheet is read once for all anchors
+    assert profiler.to_dict()['read']['calls'] == 1
+    book.save(backend='file')
+    ws = pytest.importorskip('openpyxl').load_workbook(path).active
+    assert [ws['D3'].value, ws['I3'].value, ws['D9'].value] == ['=C3*D4', '=H3*I4', '=C9*D10*2']
+    
+def test_xlsx_writer(tmp_path):
+    openpyxl = pytest.importorskip('openpyxl')
+    path = str(tmp_path / "test.xlsx")
+    wb = openpyxl.Workbook()
+    wb.active.append(['y', 85, 100])
+    wb.active['C1'].font = openpyxl.styles.Font(bold=True)
+    wb.create_sheet('other')['A1'] = 'keep'
+    wb.save(path)
+    writer = get_writer(path, backend='file')
+    writer.write_r1c1_range(1, 1, 3, 3, '=RC[-1]*2')
+    writer.save()
+    wb = openpyxl.load_workbook(path)
+    assert wb.active['C1'].value == '=B1*2'
+    assert wb.active['C1'].font.b
+    assert wb['other']['A1'].value == 'keep'
+    # R1C1 range is one shared formula, its text is stored once 
+    writer = get_writer(path, backend='file')
+    writer.write_r1c1_range(1, 2, 2, 4, '=R[-1]C+1')
+    writer.write_r1c1_range('other', 2, 1, 2, '=R[-1]C')
+    writer.save()
+    import zipfile
+    xml = zipfile.ZipFile(path).read('xl/worksheets/sheet1.xml').decode()
+    assert xml.count('t="shared"') == 3 and xml.count('B1+1') == 1
+    wb = openpyxl.load_workbook(path)
+    assert [c.value for c in wb.active['B2:D2'][0]] == ['=B1+1', '=C1+1', '=D1+1']
+    assert [c.value for c in wb['other'][2]] == ['=A1', '=B1']
+    
+def test_batch(tmp_path, monkeypatch):
+    monkeypatch.setenv('XLMODEL_CACHE_DIR', str(tmp_path / 'cache'))
+    for name in ['a.xls', 'b.xls']:
+        shutil.copy(PATH, str(tmp_path / name))
+    manifest = tmp_path / 'manifest.txt'
+    manifest.write_text("# file, sheet, anchor\na.xls, 1, A1\na.xls, input_sheet_v2, B3\nb.xls\nmissing.xls\n")
+    jobs = read_manifest(str(manifest))
+    assert jobs[1] == {'path': str(tmp_path / 'a.xls'), 'sheet': 'input_sheet_v2', 'anchor': 'B3'}
+    results = run_batch(jobs, processes=2, echo=False, backend='file')
+    assert [r['status'] for r in sorted(results, key=lambda r: r['path'])] == ['ok', 'ok', 'ok', 'failed']
+    assert batch_cli([str(tmp_path / '*.xls'), '--backend', 'file']) == 0
+    assert batch_cli(['--manifest', str(manifest), '--backend', 'file']) == 1
     
-def test_examples_folder():
+def crash_workbook(path, jobs, save_kwargs, cache = None):
+    os._exit(1)
+    
+def test_batch_worker_crash(monkeypatch):
+    # crashed worker breaks the pool, its jobs are reported as failed 
+    import xlmodel
+    monkeypatch.setattr(xlmodel, 'process_workbook', crash_workbook)
+    jobs = [{'path': name, 'sheet': 1, 'anchor': 'A1'} for name in ['a.xls', 'b.xls', 'b.xls']]
+    results = run_batch(jobs, processes=2, echo=False, backend='file')
+    assert len(results) == 3
+    assert all(r['status'] == 'failed' for r in results)
+    
+def test_formula_cache(tmp_path):
+    cache = FormulaCache(str(tmp_path / 'cache'))
+    path = str(tmp_path / PATH)
+    shutil.copy(PATH, path)
+    xl = ExcelSheet(path, 1, "A1", cache=cache)
+    assert not xl.cache_hit
+    assert (2, 3, '=C3*D4') in cache.get(xl.get_model_hash())
+    xl.save(backend='file')
+    # same model from cache, unchanged file is not written
+    stamp = os.stat(path).st_mtime_ns
+    xl = ExcelSheet(path, 1, "A1", cache=cache)
+    assert xl.cache_hit
+    assert xl.arr[2, 3] == '=C3*D4'
+    xl.save(backend='file')
+    assert os.stat(path).st_mtime_ns == stamp
+    # other anchor is other model
+    assert not ExcelSheet(path, 2, "B3", cache=cache).cache_hit
+    # equation of variable without row and blank forecast flag, from cache same as without it
+    arr = np.vstack([get_array_from_sheet(PATH, 1), [['z = y * 2', '', '', '']]])
+    arr[1, 1] = ''
+    for _ in range(2):
+        xl = ExcelSheet(path, 1, "A1", arr=arr, cache=cache)
+        assert xl.get_formula_cells() == [(2, 3, '=C3*D4')]
+    assert xl.cache_hit
+    # entries removed by other process sharing the directory
+    listed = cache._entries()
+    for _, _, entry_path in listed:
+        os.remove(entry_path)
+    cache._entries = lambda: listed
+    cache.max_bytes = 0
+    cache._evict()
+    cache.clear()
+    assert not ExcelSheet(path, 1, "A1", arr=arr, cache=cache).cache_hit
+    
+def test_formula_cache_eviction(tmp_path):
+    cache = FormulaCache(str(tmp_path), max_bytes=100)
+    cache.put('a', [(0, 0, '=A1' * 10)])
+    os.utime(str(tmp_path / 'a.json'), ns=(0, 0))
+    cache.put('b', [(0, 0, '=B1' * 10)])
+    assert cache.get('a') is None
+    assert cache.get('b') == [(0, 0, '=B1' * 10)]
+    cache.clear()
+    assert cache.get('b') is None
+    
+def test_watcher(tmp_path):
+    openpyxl = pytest.importorskip('openpyxl')
+    path = make_xlsx(str(tmp_path / "test1.xlsx"), [get_array_from_sheet(PATH, 1)])
+    watcher = Watcher([str(tmp_path)], 1, "A1", delay=0, backend='file')
+    assert [r['status'] for r in watcher.poll()] == ['updated']
+    assert openpyxl.load_workbook(path).active['D3'].value == '=C3*D4'
+    # own write is not a change 
+    assert watcher.poll() == []
+    # new data value does not change model 
+    writer = get_writer(path, backend='file')
+    writer.write_range(1, 3, 3, [[1.1]])
+    writer.save()
+    assert [r['status'] for r in watcher.poll()] == ['unchanged']
+    writer = get_writer(path, backend='file')
+    writer.write_range(1, 4, 0, [['y = y[t-1] * rog * 2']])
+    writer.save()
+    assert [r['status'] for r in watcher.poll()] == ['updated']
+    assert openpyxl.load_workbook(path).active['D3'].value == '=C3*D4*2'
+    
+def test_profiler(tmp_path):
+    import tracemalloc
+    calls = []
+    profiler = Profiler(callback=lambda name, seconds, peak: calls.append(name))
+    path = str(tmp_path / PATH)
+    shutil.copy(PATH, path)
+    ExcelSheet(path, 1, "A1", profiler=profiler).save(backend='file')
+    assert calls == ['read', 'dataset', 'equations', 'model', 'formulas', 'write']
+    with profiler.phase('outer'):
+        with profiler.phase('inner'):
+            x = bytearray(10**6)
+        del x
+    stats = profiler.to_dict()
+    assert stats['inner']['peak_bytes'] >= 10**6
+    assert stats['outer']['peak_bytes'] >= stats['inner']['peak_bytes']
+    assert stats['outer']['seconds'] >= stats['inner']['seconds']
+    assert stats['read']['calls'] == 1
+    assert not tracemalloc.is_tracing()
+    # tracing started by caller is left running and its peak is not reset 
+    tracemalloc.start()
+    try:
+        y = bytearray(2 * 10**6)
+        del y
+        with Profiler().phase('caller'):
+            x = bytearray(10**6)
+        assert tracemalloc.is_tracing()
+        assert tracemalloc.get_traced_memory()[1] >= 2 * 10**6
+    finally:
+        tracemalloc.stop()
+    # command line profile without FILE is the only output on stdout
+    import json
+    output = subprocess.check_output([sys.executable, os.path.abspath('xlmodel.py'), path, 
+                                      '--backend', 'file', '--no-cache', '--profile'], stderr=subprocess.DEVNULL)
+    assert json.loads(output.decode())['write']['calls'] == 1
+    
+def test_formula_service():
+    import asyncio
+    import concurrent.futures
+    import json
+    import urllib.request
+    service = FormulaService(max_models=1)
+    request = {'equations': EQS, 'var_to_rows': VAR_TO_ROWS, 'anchor': 'A1', 'is_forecast': [0, 0, 1]}
+    assert service.get_formulas(request) == {'order': ['y'], 'formulas': {'y': [None, None, '=C3*D4']}}
+    service.get_formulas(request)
+    assert (service.hits, service.misses) == (1, 1)
+    service.get_formulas(dict(request, is_forecast=[0, 1, 1]))
+    assert len(service.models) == 1
+    
+    def post(port, body):
+        req = urllib.request.Request('http://127.0.0.1:%d/formulas' % port, json.dumps(body).encode())
+        try:
+            return json.loads(urllib.request.urlopen(req).read())
+        except urllib.error.HTTPError as e:
+            return e.code
+    
+    async def main():
+        ready = asyncio.get_running_loop().create_future()
+        server = asyncio.ensure_future(service.serve(port=0, ready=ready.set_result))
+        port = await ready
+        loop = asyncio.get_running_loop()
+        # blocking clients run in their own threads, apart from the service pool
+        with concurrent.futures.ThreadPoolExecutor(max_workers=5) as clients:
+            results = await asyncio.gather(*[loop.run_in_executor(clients, post, port, request) for _ in range(4)],
+                                           loop.run_in_executor(clients, post, port, {'equations': EQS}))
+        server.cancel()
+        return results
+    
+    results = asyncio.run(main())
+    assert results[:4] == [{'order': ['y'], 'formulas': {'y': [None, None, '=C3*D4']}}] * 4
+    assert results[4] == 400
+    
+def test_auto_backend_refuses_xls(tmp_path):
+    # without Excel, .xls would lose its formulas, .xlsx is written directly
+    if sys.platform != 'win32':
+        with pytest.raises(ValueError):
+            get_writer(PATH)
+    with pytest.warns(UserWarning):
+        get_writer(PATH, backend='file')
+    path = str(tmp_path / 'book.xlsx')
+    openpyxl = pytest.importorskip('openpyxl')
+    openpyxl.Workbook().save(path)
+    assert get_writer(path) is not None
 
-    ExcelSheet("test0.xls").save()
-    ExcelSheet("test1.xls", 1, "A1").save(sheet=3)
-    ExcelSheet("test1.xls", 2, "B3").save(sheet=4)
+def run_example(tmp_path, filename, sheet=1, anchor="c1"):
+    # fixtures are copied, the committed files stay untouched
+    path = str(tmp_path / filename)
+    shutil.copy(os.path.join('examples', filename), path)
+    ExcelSheet(path, sheet, anchor).save(backend='file')#.echo()
+    
+def test_examples_folder(tmp_path):
+    for filename in ["test0.xls", "test1.xls"]:
+        shutil.copy(filename, str(tmp_path / filename))
+    ExcelSheet(str(tmp_path / "test0.xls")).save(backend='file')
+    ExcelSheet(str(tmp_path / "test1.xls"), 1, "A1").save(sheet=3, backend='file')
+    ExcelSheet(str(tmp_path / "test1.xls"), 2, "B3").save(sheet=4, backend='file')
 
-    run_example('bdrn.xls')
-    run_example('ref_file.xls')
-    run_example('spec.xls')
-    run_example('spec2.xls')
-    run_example('bank.xls')
-    run_example('bank_sector.xls')
\ No newline at end of file
+    run_example(tmp_path, 'bdrn.xls')
+    run_example(tmp_path, 'ref_file.xls')
+    run_example(tmp_path, 'spec.xls')
+    run_example(tmp_path, 'spec2.xls')
+    run_example(tmp_path, 'bank.xls')
+    run_example(tmp_path, 'bank_sector.xls')
\ No newline at end of file
@@ -37,14 +37,21 @@ Comment:
 """
 
 
-import pandas as pd
+# pandas, xlrd, openpyxl, xlwt/xlutils and xlwings are imported on first use, 
+# so that formula generation and command line help do not load them 
 import numpy as np
 from collections import OrderedDict
+import contextlib
+import functools
+import glob
+import hashlib
+import io
+import json
 import re
-import xlrd
-from xlwings import Workbook, Range, Sheet
 import argparse
 import os
+import sys
+import time
 
 
 #----------------------------------------------------------------------------------
@@ -53,11 +60,20 @@ import os
 #
 #----------------------------------------------------------------------------------
 
+def colname(colx):
+    """Return column letters for column index *colx* based at 0, e.g. 0 -> 'A', 26 -> 'AA'."""
+    name = ''
+    colx += 1
+    while colx > 0:
+        colx, rem = divmod(colx - 1, 26)
+        name = chr(ord('A') + rem) + name
+    return name
+
 def to_xl_ref(row, col, base = 1):
     if base == 1:
-        return xlrd.colname(col-1) + str(row)
+        return colname(col-1) + str(row)
     elif base == 0:
-        return xlrd.colname(col) + str(row+1)
+        return colname(col) + str(row+1)
 
 def col_to_num(col_str):
     """ Convert base26 column string to number. """
@@ -73,6 +89,59 @@ def to_rowcol(xl_ref, base = 1):
     letters, b =  re.search(r'(\D+)(\d+)', xl_ref).groups()        
     return int(b) + (base-1), col_to_num(letters) + (base-1) 
     
+def r1c1_offset(letter, offset):
+    """Return relative R1C1 part, e.g. 'R' for 0, 'R[-1]' for -1, 'C[2]' for 2."""
+    if offset == 0:
+        return letter
+    return letter + '[' + str(offset) + ']'
+
+def get_runs(positions):
+    """Split sorted integer positions into (first, last) runs of consecutive values."""
+    runs = []
+    for x in positions:
+        if runs and runs[-1][1] == x - 1:
+            runs[-1][1] = x
+        else:
+            runs.append([x, x])
+    return [tuple(run) for run in runs]
+    
+def get_rectangles(rows):
+    """
+    Coalesce cells given as (rowx, sorted colx positions) for ascending rows into 
+    contiguous rectangles: runs of cells in a row, then same runs on adjacent rows. 
+    Returns sorted list of ((top_rowx, bottom_rowx), (first_colx, last_colx)).
+    """
+    # (first_colx, last_colx) -> [top_rowx, bottom_rowx] for rectangles that may grow downwards 
+    open_rects = {}
+    rects = []
+    for rowx, positions in rows:
+        runs = get_runs(positions)
+        for run in list(open_rects.keys()):
+            if run not in runs or open_rects[run][1] != rowx - 1:
+                rects.append((open_rects.pop(run), run))
+        for run in runs:
+            if run in open_rects:
+                open_rects[run][1] = rowx
+            else:
+                open_rects[run] = [rowx, rowx]
+    rects.extend((rows, run) for run, rows in open_rects.items())
+    return sorted(rects)
+    
+def get_changed_ranges(old_arr, new_arr):
+    """
+    Return list of (rowx, colx, values) for cells that differ between 
+    two arrays of same shape or two CellStores. Changed cells are coalesced 
+    into contiguous rectangles, see get_rectangles(). 
+    *values* is a 2D list, *rowx* and *colx* are based at 0.
+    """
+    if isinstance(new_arr, CellStore):
+        return new_arr.get_changed_ranges(old_arr)
+    
+    changed = np.asarray(old_arr != new_arr, dtype=bool)
+    rects = get_rectangles((rowx, np.flatnonzero(changed[rowx])) for rowx in np.flatnonzero(changed.any(axis=1)))
+    return [(int(top), int(first), new_arr[top:bottom+1, first:last+1].tolist()) 
+            for (top, bottom), (first, last) in rects]
+
 def is_equal(df1, df2):
     # in numpy/pandas nan == nan is False, must substitute nans to compare frames
     # also 1 == 1.0 is false
@@ -95,6 +164,41 @@ SEGMENT_REGEX = r'(\w+\[\d+\])'
 # from 'GDP[5]' catches 'GDP', '5' 
 VAR_PERIOD_REGEX = r'(\w+)\[(\d+)\]' 
 
+# from 't-1' catches '-', '1'; allows only 't' and integers joined by '+' or '-'
+TIME_INDEX_TERM_REGEX = r'([+\-]?)(t|\d+)'
+
+# from 'y[t-1]*1.05+MAX(' catches name 'y' with index '[t-1]', other '*', number '1.05', other '+', name 'MAX', other '('
+EQUATION_TOKEN_REGEX = re.compile(r'(?P<number>\d+\.?\d*(?:[eE][+\-]?\d+)?|\.\d+(?:[eE][+\-]?\d+)?)'
+                                  r'|(?P<name>[^\W\d]\w*)(?P<index>\[[^\]]*\])?'
+                                  r'|(?P<other>[^\w.]+|.)', re.DOTALL)
+
+
+def parse_time_index(time_index_expression):
+    """
+    Parse time index expression like 't', 't-1', 't+2' or '5' without eval(). 
+    
+    Returns tuple (is_relative, offset): ('t-1' -> (True, -1), '5' -> (False, 5)).
+    Raises ValueError for anything else than 't' and integers joined by '+' or '-'.
+    """
+    
+    expr = time_index_expression
+    t_count = 0
+    offset = 0
+    pos = 0
+    for m in re.finditer(TIME_INDEX_TERM_REGEX, expr):
+        sign, term = m.groups()
+        if m.start() != pos or (pos > 0 and not sign):
+            break
+        k = -1 if sign == '-' else 1
+        if term == 't':
+            t_count += k
+        else:
+            offset += k * int(term)
+        pos = m.end()
+    if pos == 0 or pos != len(expr) or t_count not in (0, 1):
+        raise ValueError('Time index expression invalid: ' + expr)
+    return t_count == 1, offset
+
 
 class FormulaSegment():
     
@@ -174,27 +278,131 @@ class Formula():
       
     @staticmethod    
     def expand_shorthand(text, var_to_rows):
-        for var in [v for v in var_to_rows.keys() if v]:
-           # catches GDP without further [] 
-           rx = var + r'(?!\s*[\dA-Za-z_^\[])'
-           text = re.sub(rx, var + '[t]', text)
-        return text  
+        # GDP without further [] becomes GDP[t]
+        return tokenize_equation(text, var_to_rows)[0]
 
     @staticmethod    
     def evaluate_time_indices(text, time_period):
         
         for time_index_expression in re.findall(T_ONLY_REGEX, text):
-            try:
-                # 't' will be used inside time_index_expression                 
-                t = time_period
-                period_offset = eval(time_index_expression)
-            except:
-                raise ValueError('Time idex expression invalid: ' + time_index_expression)
-            
+            is_relative, period_offset = parse_time_index(time_index_expression)
+            if is_relative:
+                period_offset += time_period
             text = text.replace('[' + time_index_expression + ']', 
                                 '[' + str(period_offset)    + ']')
         return text         
 
+def tokenize_equation(equation_string, var_to_rows):
+    """
+    Split equation into text pieces and variable references.
+    
+    Returns tuple (text, parts, refs): 
+        text - equation with whitespace stripped and shorthand expanded, e.g. 'y[t-1]*rog[t]' 
+        parts - text between references, one item longer than refs, e.g. ['', '*', '']
+        refs - (varname, is_relative, offset) for each reference, e.g. [('y', True, -1), ('rog', True, 0)]
+    """
+    text = Formula.strip_all_whitespace(equation_string)
+    # single pass over tokens, names are resolved by dictionary lookup in var_to_rows:
+    # name with index is a reference, known name without index is shorthand for name[t], 
+    # other names (e.g. functions followed by '(') and numbers are literal text
+    expanded = []
+    parts = []
+    refs = []
+    literal = []
+    for m in EQUATION_TOKEN_REGEX.finditer(text):
+        varname, index = m.group('name'), m.group('index')
+        if index is None and varname is not None and varname in var_to_rows and text[m.end():m.end() + 1] != '(':
+            index = '[t]'
+        if index is None:
+            literal.append(m.group(0))
+            continue
+        is_relative, offset = parse_time_index(index[1:-1])
+        parts.append(''.join(literal))
+        expanded.extend((parts[-1], varname, index))
+        refs.append((varname, is_relative, offset))
+        literal = []
+    parts.append(''.join(literal))
+    expanded.append(parts[-1])
+    return ''.join(expanded), parts, refs
+
+class FormulaTemplate():
+    """
+    Equation compiled once into literal text pieces and cell references 
+    with pre-resolved rows and relative time offsets. Excel formula for 
+    any time period is then rendered by string concatenation, without 
+    re-parsing the equation.
+    
+    Methods
+    -------
+    
+    get_xl_formula(period)
+    
+       Example:
+       template = FormulaTemplate(equation_string, var_to_rows)
+       xl_refs = [template.get_xl_formula(period) for period in (3, 4, 5)]
+
+    """
+    
+    def __init__(self, equation_string, var_to_rows, anchor = "A1"):
+        """
+        Parameters
+        ----------
+        equation_string : equation for variable as text string
+        var_to_rows : dictionary mapping variable names to rows on Excel sheet. Row numbers are based at 1. 
+        anchor : A1-style reference to upper-left corner of the data block on Excel sheet, defaults to 'A1'
+    
+        """
+        
+        self.equation_string, self.parts, var_refs = tokenize_equation(equation_string, var_to_rows)
+        
+        # anchor is used to calculate column offset, same as in FormulaSegment
+        r, c = to_rowcol(anchor)
+        self.column_offset = int(c)
+        
+        # self.parts holds text between references, it is one item longer than self.refs
+        # self.refs holds (row, is_relative, offset) for each reference
+        self.refs = []
+        for varname, is_relative, offset in var_refs:
+            if varname not in var_to_rows.keys():
+                raise KeyError("Variable without row: " + varname)
+            self.refs.append((var_to_rows[varname], is_relative, offset))
+        self._row_strings = [str(row) for row, _, _ in self.refs]
+        
+    # column names shared by all templates, memory grows with number of columns only  
+    _colnames = {}
+        
+    def _colname(self, col):
+        # col is based at 1, cached as same columns are rendered for every equation row 
+        try:
+            return self._colnames[col]
+        except KeyError:
+            name = self._colnames[col] = colname(col-1)
+            return name
+
+    def get_r1c1_formula(self, row):
+        """Return relative R1C1-style formula for variable at *row*, same for all forecast periods."""
+        pieces = ['=', self.parts[0]]
+        for (ref_row, is_relative, offset), text in zip(self.refs, self.parts[1:]):
+            pieces.append(r1c1_offset('R', ref_row - row))
+            if is_relative:
+                pieces.append(r1c1_offset('C', offset))
+            else:
+                pieces.append('C' + str(offset + self.column_offset))
+            pieces.append(text)
+        return ''.join(pieces)
+
+    def get_xl_formula(self, time_period):
+        pieces = ['=', self.parts[0]]
+        for (row, is_relative, offset), row_string, text in zip(self.refs, self._row_strings, self.parts[1:]):
+            col = (time_period + offset if is_relative else offset) + self.column_offset
+            pieces.append(self._colname(col))
+            pieces.append(row_string)
+            pieces.append(text)
+        return ''.join(pieces)
+        
+    def __repr__(self):
+        return self.equation_string
+
 class Equations():
     
     def __init__(self, equation_strings):
@@ -224,15 +432,121 @@ class Equations():
                          "\nExisting equation: " + eq1 +
                          "\nAlternative equation: " + eq2)
 
+class Dataset():
+    """
+    Model dataset held in NumPy arrays: variables in rows, periods in columns.
+    Dataframe with periods in index and variables in columns is available as a view.
+    
+    Parameters
+    ----------
+    labels : variable names 
+    periods : period labels, e.g. years 
+    values : 2D array of cell values of shape (variables, periods)
+    
+    Attributes
+    ----------
+    index - dictionary of variable name to row in values 
+    values - object array of cell values  
+    formulas - object array of same shape with formulas, None where there is no formula
+    is_forecast - values of 'is_forecast' variable, None if there is no such variable 
+    forecast_mask, forecast_positions - forecast periods as boolean mask and as positions 
+    
+    Methods
+    -------
+    from_dataframe(df), from_array(arr, anchor_rowx, anchor_colx) - create dataset 
+    drop(labels) - remove variables
+    to_dataframe(formulas) - dataframe view, with formulas in place of values if *formulas* is True 
+    
+    """
+    
+    def __init__(self, labels, periods, values):
+        self.labels = list(labels)
+        self.periods = list(periods)
+        self.values = np.asarray(values, dtype=object).reshape(len(self.labels), len(self.periods))
+        self.formulas = np.full(self.values.shape, None, dtype=object)
+        self.index = dict((label, i) for i, label in enumerate(self.labels))
+        self.is_forecast = None
+        self.forecast_mask = np.zeros(len(self.periods), dtype=bool)
+        if 'is_forecast' in self.index:
+            self.is_forecast = list(self.values[self.index['is_forecast']])
+            self.forecast_mask = np.array([flag == 1 for flag in self.is_forecast], dtype=bool)
+        self.forecast_positions = np.flatnonzero(self.forecast_mask)
+    
+    @classmethod
+    def from_dataframe(cls, df):
+        """Dataset from dataframe with periods in index and variables in columns."""
+        return cls(df.columns, df.index, df.to_numpy(dtype=object).T)
+        
+    @classmethod
+    def from_array(cls, arr, anchor_rowx, anchor_colx):
+        """Dataset from part of sheet array starting at anchor cell: periods in first row, labels in first column."""
+        data = arr[anchor_rowx:, anchor_colx:]
+        return cls(data[1:, 0], data[0, 1:], data[1:, 1:])
+        
+    def copy(self):
+        other = Dataset(self.labels, self.periods, self.values.copy())
+        other.formulas = self.formulas.copy()
+        return other
+        
+    def drop(self, labels):
+        """Return dataset without variables in *labels*."""
+        labels = set(labels)
+        keep = [i for i, label in enumerate(self.labels) if label not in labels]
+        other = Dataset([self.labels[i] for i in keep], self.periods, self.values[keep])
+        other.formulas = self.formulas[keep]
+        return other
+        
+    def to_dataframe(self, formulas = False):
+        import pandas as pd
+        values = self.values
+        if formulas:
+            values = np.where(self.formulas != None, self.formulas, self.values)
+        return pd.DataFrame(values.T, index = self.periods, columns = self.labels).infer_objects()
+    
+def get_formula_rows(equations, var_to_rows, anchor, positions):
+    """
+    Return list with formulas of each equation in forecast *positions* of periods (based at 0). 
+    Needs no dataset, used to generate formulas in worker processes.
+    """
+    rows = []
+    for equation in equations:
+        template = FormulaTemplate(equation, var_to_rows, anchor)
+        # period_n is position + 1
+        rows.append([template.get_xl_formula(i + 1) for i in positions])
+    return rows
+
+# arguments of get_formula_rows() shared by all chunks, set once in each worker process 
+_formula_worker = {}
+
+def _init_formula_worker(var_to_rows, anchor, positions):
+    _formula_worker.update(var_to_rows = var_to_rows, anchor = anchor, positions = positions)
+    
+def _get_formula_rows_in_worker(equations):
+    return get_formula_rows(equations, **_formula_worker)
+    
 class MathModel():
     """    
-    Fill dataframe with formulas containing A1 cell references based on 
+    Fill dataset with formulas containing A1 cell references based on 
     equations and variable locations on Excel sheet. 
     
     Methods
     -------
     set_xl_postioning(var_to_rows, anchor)
-    get_xl_dataset()
+    get_xl_formulas(varnames) - fill formula array of dataset, return filled variables
+    iter_xl_formulas(varnames, chunk_size) - generate formulas chunk by chunk of forecast periods
+    iter_formula_ranges(chunk_size) - rectangles of sheet cells with formulas, chunk by chunk
+    save_snapshot(path), from_snapshot(path) - write and read model in binary snapshot file
+    get_xl_dataset(varnames) - dataframe view with formulas
+    evaluate() - compute forecast values with NumPy
+    sweep(controls) - compute forecast values for many scenarios of control variables
+    update(equations, var_to_rows) - replace equations or rows, return dependent variables to regenerate
+    
+    Attributes
+    ----------
+    data - Dataset with values and formulas 
+    dataset - dataframe view of values
+    references - dictionary of dependent variable to set of variables in its equation 
+    order - dependent variables in order of calculation within a period 
     
     """
     
@@ -240,21 +554,105 @@ class MathModel():
        """
        Parameters
        ----------
-       dataset : dataframe with time series for variables by year
+       dataset : Dataset or dataframe with time series for variables by year
        equations : list of text strings holding equations for variables
        
        """
         
-       # warning: using dataset.copy() to prevent the global variable from being modified inside the class
-       self.dataset = dataset.copy()
+       # warning: using copy to prevent the global variable from being modified inside the class
+       self.dataset = dataset
        self.equations = Equations(equations).dict 
        self._validate_math_model()
+       
+    @property
+    def dataset(self):
+        return self.data.to_dataframe()
+        
+    @dataset.setter
+    def dataset(self, dataset):
+        self.data = dataset.copy() if isinstance(dataset, Dataset) else Dataset.from_dataframe(dataset)
     
     def _validate_math_model(self):                
         # Validating mathematic model:
         #    + check if enough data for equations were given
         #    + check if there are left-hand variables in equations without prior data 
-        pass
+        #    + check there are no cycles within period, get order of calculation 
+        self.references = OrderedDict()
+        # same_period[x] holds dependent variables that x[t] uses at [t]   
+        same_period = OrderedDict()
+        varnames = OrderedDict.fromkeys(self.data.labels + list(self.equations.keys()))
+        for varname, equation in self.equations.items():
+            text, parts, refs = tokenize_equation(equation, varnames)
+            self.references[varname] = set(ref[0] for ref in refs)
+            same_period[varname] = set(ref[0] for ref in refs 
+                                       if ref[1] and ref[2] == 0 and ref[0] in self.equations)
+        self.order = self.get_order(same_period)
+        self._evaluator = None
+    
+    @staticmethod
+    def get_order(same_period):
+        """
+        Return dependent variables in topological order: each variable comes after 
+        variables it uses in the same period. Raises ValueError on cycle.
+        """
+        order = []
+        done = set()
+        # depth-first search, 'visiting' holds current path to detect cycles
+        for root in same_period.keys():
+            if root in done:
+                continue
+            visiting = [root]
+            stack = [iter(sorted(same_period[root]))]
+            while stack:
+                child = next(stack[-1], None)
+                if child is None:
+                    stack.pop()
+                    order.append(visiting.pop())
+                    done.add(order[-1])
+                elif child in visiting:
+                    cycle = visiting[visiting.index(child):] + [child]
+                    raise ValueError("Equations have a cycle within period: " + " -> ".join(cycle))
+                elif child not in done:
+                    visiting.append(child)
+                    stack.append(iter(sorted(same_period[child])))
+        return order
+        
+    def get_affected(self, changed_equations = (), moved_rows = ()):
+        """
+        Return dependent variables whose formulas change, in calculation order: 
+        variables in *changed_equations* and variables with equations using *moved_rows*.
+        """
+        changed_equations, moved_rows = set(changed_equations), set(moved_rows) 
+        return [v for v in self.order if v in changed_equations or self.references[v] & moved_rows]
+        
+    def update(self, equations = None, var_to_rows = None):
+        """
+        Replace equations and/or variable rows. Return list of dependent variables 
+        whose formulas must be regenerated, variables without equation anymore are 
+        also included at the end of the list. 
+        
+        Parameters
+        ----------
+        equations : list of text strings holding equations for variables
+        var_to_rows : dictionary mapping variable names to rows on Excel sheet. Row numbers are based at 1. 
+        """
+        changed_equations = set()
+        moved_rows = set()
+        removed = []
+        if equations is not None:
+            new_equations = Equations(equations).dict
+            changed_equations.update(k for k in new_equations if new_equations[k] != self.equations.get(k))
+            removed = [k for k in self.equations if k not in new_equations]
+            self.equations = new_equations
+            self._validate_math_model()
+        if var_to_rows is not None:
+            moved_rows.update(k for k in set(var_to_rows) | set(self.var_to_rows) 
+                              if var_to_rows.get(k) != self.var_to_rows.get(k))
+            # formula of moved dependent variable does not change, but it is written to other row
+            changed_equations.update(moved_rows)
+            self.var_to_rows = var_to_rows
+            self._validate_positioning()
+        return self.get_affected(changed_equations, moved_rows) + removed
         
     def _validate_positioning(self):     
         # Validating Excel positioning model:        
@@ -278,230 +676,2490 @@ class MathModel():
         self._validate_positioning()
         return self 
         
-    def get_xl_dataset(self):
-        
-        xl_dataset = self.dataset 
+    def get_xl_formulas(self, varnames = None, processes = None, chunk_size = 2000):
+        """
+        Fill self.data.formulas in forecast periods, only for *varnames* if given. 
+        With *processes* > 1 formulas of *chunk_size* equations at a time are generated 
+        in a pool of processes, see get_formula_rows(). Result is same as in serial run. 
+        Returns list of filled variables in calculation order.
+        """
         
-        # rows where is_forecast == 1        
-        forecast_index_positions = [t for t, flag in enumerate(xl_dataset.is_forecast) if flag == 1]
+        data = self.data
+        if processes is not None and processes > 1:
+            filled = [v for v in self.order if (varnames is None or v in varnames) and v in data.index]
+            if len(filled) > chunk_size:
+                self._fill_formulas_in_pool(filled, processes, chunk_size)
+                return filled
+        filled = []
         
         # for each variable name on left hand side of equations...          
-        for varname in self.equations.keys():
-            # ... get formula for the variable ...
-            equation = self.equations[varname]
-            # .. go over forecast time periods... 
-            for i in forecast_index_positions:
-               # .... and assign formulas in xl_dataset
-               period_n = i + 1
-               xl_dataset.loc[xl_dataset.index[i], varname] = \
-                        Formula(equation, 
-                                self.var_to_rows,
-                                self.anchor).get_xl_formula(period_n)
+        for varname in self.order:
+            if varnames is not None and varname not in varnames or varname not in data.index:
+                continue
+            # ... compile formula for the variable once ...
+            template = FormulaTemplate(self.equations[varname], 
+                                       self.var_to_rows,
+                                       self.anchor)
+            # ... and assign formulas for all forecast periods to its row, period_n is i + 1
+            data.formulas[data.index[varname], data.forecast_positions] = \
+                [template.get_xl_formula(i + 1) for i in data.forecast_positions]
+            filled.append(varname)
                         
-        return xl_dataset
+        return filled
+        
+    def _fill_formulas_in_pool(self, varnames, processes, chunk_size):
+        import concurrent.futures
+        data = self.data
+        chunks = [varnames[i:i + chunk_size] for i in range(0, len(varnames), chunk_size)]
+        # workers get rows and forecast periods once and equations by chunk, dataset is not sent   
+        initargs = (self.var_to_rows, self.anchor, [int(t) for t in data.forecast_positions])
+        with concurrent.futures.ProcessPoolExecutor(processes, initializer = _init_formula_worker, 
+                                                    initargs = initargs) as pool:
+            results = pool.map(_get_formula_rows_in_worker, [[self.equations[v] for v in chunk] for chunk in chunks])
+            # partial grids are merged in order as they arrive 
+            for chunk, rows in zip(chunks, results):
+                for varname, row in zip(chunk, rows):
+                    data.formulas[data.index[varname], data.forecast_positions] = row
+        
+    def iter_xl_formulas(self, varnames = None, chunk_size = 1):
+        """
+        Generate formulas column by column without filling self.data.formulas, only for *varnames* if given.
+        Yields (positions, varnames, rows) for each chunk of up to *chunk_size* forecast periods: 
+        *rows* holds formulas of each variable of *varnames* in periods at *positions* (based at 0). 
+        Memory is bounded by chunk size and not by number of periods.
+        """
+        data = self.data
+        varnames = [v for v in self.order if (varnames is None or v in varnames) and v in data.index]
+        # formulas are compiled once, rendered chunk by chunk
+        templates = [FormulaTemplate(self.equations[v], self.var_to_rows, self.anchor) for v in varnames]
+        for start in range(0, len(data.forecast_positions), chunk_size):
+            positions = [int(t) for t in data.forecast_positions[start:start + chunk_size]]
+            # period_n is position + 1
+            yield positions, varnames, [[template.get_xl_formula(t + 1) for t in positions] for template in templates]
+        
+    def iter_formula_ranges(self, chunk_size = 1):
+        """
+        Yield (rowx, colx, values) rectangles of sheet cells (based at 0) with formulas of 
+        *chunk_size* forecast periods at a time, see iter_xl_formulas().
+        """
+        anchor_colx = to_rowcol(self.anchor, base = 0)[1]
+        for positions, varnames, rows in self.iter_xl_formulas(chunk_size = chunk_size):
+            chunk = CellStore()
+            forecast_colx = [anchor_colx + 1 + t for t in positions]
+            for varname, row in zip(varnames, rows):
+                chunk[self.var_to_rows[varname] - 1, forecast_colx] = row
+            for rectangle in chunk.get_ranges():
+                yield rectangle
+                
+    def save_snapshot(self, path, source = None):
+        """Write model with variable rows and anchor to binary snapshot file, see ModelSnapshot."""
+        ModelSnapshot.from_model(self, source).save(path)
+        return self
         
+    @classmethod
+    def from_snapshot(cls, path):
+        """Return model with variable rows and anchor from snapshot file, see ModelSnapshot."""
+        return ModelSnapshot.load(path).get_model()
+        
+    def get_xl_dataset(self, varnames = None, processes = None):
+        """Return dataframe with formulas in forecast periods, only for *varnames* if given."""
+        self.get_xl_formulas(varnames, processes)
+        return self.data.to_dataframe(formulas = True)
 
-#----------------------------------------------------------------------------------
-#
-#    ExcelSheet class
-#
-#----------------------------------------------------------------------------------
+    def get_r1c1_ranges(self):
+        """
+        Return list of (row, first_col, last_col, formula) tuples with one relative R1C1 
+        formula for each dependent variable and each contiguous run of forecast periods. 
+        Rows and columns are based at 1. 
+        """
+        
+        r, c = to_rowcol(self.anchor)
+        # period_n is i + 1 and is located in column period_n + c
+        column_runs = [(first + 1 + c, last + 1 + c) for first, last in get_runs(self.data.forecast_positions)]
+        
+        ranges = []
+        for varname in self.order:
+            # same variables as in get_xl_formulas()
+            if varname not in self.data.index:
+                continue
+            row = self.var_to_rows[varname]
+            formula = FormulaTemplate(self.equations[varname], self.var_to_rows, self.anchor).get_r1c1_formula(row)
+            for first_col, last_col in column_runs:
+                ranges.append((row, first_col, last_col, formula))
+        return ranges
 
-       
-def _get_xlrd_sheet(filename, sheet):
-   
-   contentstring = open(filename, 'rb').read()
-   book = xlrd.open_workbook(file_contents=contentstring)
-   
-   if isinstance(sheet, int):
-       # if 'sheet' is integer, we assume 'sheet' is based at 1   
-       return book.sheet_by_index(sheet-1)
-   elif isinstance(sheet, str) and sheet in book.sheet_names():
-       return book.sheet_by_name(sheet)
-   else:
-       raise Exception("Cannot find sheet :" + str(sheet))
-       
-def get_array_from_sheet(filename, sheet):
-    sheet = _get_xlrd_sheet(filename, sheet)       
-    array = np.empty((sheet.nrows,sheet.ncols), dtype=object)
-    for row in range(sheet.nrows):
-        for col in range(sheet.ncols):
-            value = sheet.cell(row, col).value
-            # force values type to 'int' where possible
-            if isinstance(value, float) and round(value) == value:
-                value = int(value)                
-            array[row][col] = value
-    return array              
+    def get_values(self):
+        """Return dataset as float array of shape (variables, periods), see to_float() for conversion of cells."""
+        return np.frompyfunc(to_float, 1, 1)(self.data.values).astype(float)
+        
+    def get_evaluator(self):
+        """Return ModelEvaluator for equations, it is kept until equations change."""
+        if self._evaluator is None:
+            self._evaluator = ModelEvaluator(self.equations, self.data.labels, self.order)
+        return self._evaluator
 
-def _fullpath(path):
-    
-    # current directory
-    cur_dir = os.path.dirname(os.path.abspath(__file__))
+    def evaluate(self):
+        """
+        Compute forecast values for dependent variables without Excel.
+        Returns dataframe like dataset with numbers, empty cells are 0 as in Excel.
+        """
+        import pandas as pd
+        values = self.get_evaluator().run(self.get_values()[np.newaxis], self.data.forecast_mask)[0]
+        return pd.DataFrame(values.T, index = self.data.periods, columns = self.data.labels)
 
-    if os.path.normcase(os.path.normpath(path)).startswith(cur_dir):
-       return path
-    else:
-       return os.path.join(cur_dir, path)
+    def sweep(self, controls, varnames = None, chunk_size = 1000, dtype = float):
+        """
+        Compute forecast values for many scenarios of control variables at once.
+        
+        Parameters
+        ----------
+        controls : dictionary of variable name to array of shape (scenarios, periods), 
+                   rows of shape (periods,) are used for all scenarios 
+        varnames : variables to return, defaults to dependent variables in calculation order (self.order)
+        chunk_size : number of scenarios computed together, limits memory use 
+        dtype : type of returned values, e.g. np.float32 for smaller result 
+        
+        Returns array of shape (scenarios, len(varnames), periods).
+        """
+        index = self.data.index
+        varnames = list(self.order if varnames is None else varnames)
+        for v in list(controls.keys()) + varnames:
+            if v not in index:
+                raise KeyError("Variable not in dataset: " + str(v))
+        periods = len(self.data.periods)
+        
+        controls = dict((v, np.asarray(x, dtype=float).reshape(-1, periods)) for v, x in controls.items())
+        sizes = set(x.shape[0] for x in controls.values()) - {1}
+        if len(sizes) > 1:
+            raise ValueError("Different number of scenarios for controls: " + str(sorted(sizes)))
+        n = sizes.pop() if sizes else 1
+        
+        base = self.get_values()
+        evaluator = self.get_evaluator()
+        control_index = [(index[v], x) for v, x in controls.items()]
+        result_index = [index[v] for v in varnames]
+        result = np.empty((n, len(varnames), periods), dtype=dtype)
+        for start in range(0, n, chunk_size):
+            stop = min(start + chunk_size, n)
+            values = np.repeat(base[np.newaxis], stop - start, axis=0)
+            for i, x in control_index:
+                values[:, i, :] = x[start:stop] if x.shape[0] > 1 else x
+            result[start:stop] = evaluator.run(values, self.data.forecast_mask)[:, result_index, :]
+        return result
+        
 
-def write_array_to_sheet(filepath, sheet, arr):
+#----------------------------------------------------------------------------------
+#
+#    Numeric evaluation
+#
+#----------------------------------------------------------------------------------
 
-    path = _fullpath(filepath) # Workbook(path) seems to fail unless full path is provided
-    if os.path.exists(path):
-        wb = Workbook(path)
-        Sheet(sheet).activate()
-        Range("A1").value = arr 
-        wb.save()
-    else:
-        raise FileNotFound(path) 
-   
+# from '*0.5+MAX(' catches '*', '0.5', '+', 'MAX', '('
+LITERAL_TOKEN_REGEX = r'\s*(\d+\.?\d*(?:[eE][+\-]?\d+)?|\.\d+(?:[eE][+\-]?\d+)?|[A-Za-z_]\w*|[+\-*/^(),])'
 
-class ExcelSheet():
+# Excel functions allowed in equations for numeric evaluation 
+EVAL_FUNCTIONS = {'ABS': np.abs, 'EXP': np.exp, 'LN': np.log, 'LOG10': np.log10, 'SQRT': np.sqrt, 
+                  'MAX': lambda *xs: functools.reduce(np.maximum, xs), 
+                  'MIN': lambda *xs: functools.reduce(np.minimum, xs)}
 
+def to_float(value):
+    """Return value as float: 0 for empty cells as in Excel, nan for text and formulas."""
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return float(value)
+    if hasattr(value, 'dtype') and np.issubdtype(value.dtype, np.number):
+        return float(value)
+    if value is None or value == '':
+        return 0.0
+    return np.nan
+    
+class ModelEvaluator():
     """
-
-    Access Excel file for reading sheet and saving sheet with new formulas.
+    Computes forecast values for equations with NumPy, without Excel. 
     
-    Notes
-    -----
-    - Operates on numpy array *self.arr* representing cells in Excel sheet. 
-    - Uses MathModel class to update formulas.   
+    Values are held in array of shape (scenarios, variables, periods). 
+    Equations without lags of dependent variables are computed for all forecast 
+    periods at once, other equations are computed period by period.
     
     Methods
     -------
-    .insert_formulas() - populate cells in forecast periods with Excel-style formulas. 
-    .save() - update formulas and saves Excel file.
-
+    run(values, is_forecast) - fill forecast periods in *values* with equation results
+    
     """
     
-    def __init__(self, filepath, sheet = 1, anchor = 'A1'):
+    def __init__(self, equations, varnames, order):
         """
-        Inputs
-        ------
-        filepath : valid path to Excel file, xls only, xlsx not supported
-            sheet: string or integer >=1, representing sheet name or number starting at 1, defaults to first sheet 
-          anchor : string with A1 style reference, defaults to "A1"
-        """ 
+        Parameters
+        ----------
+        equations : dictionary of dependent variable to equation text  
+        varnames : list of all variable names, defines second axis of values array
+        order : dependent variables in order of calculation within a period
         
-        print(filepath)
-        self.source = {'path':filepath, 'sheet':sheet, 'anchor':anchor}
-        self.arr = get_array_from_sheet(filepath, sheet)
-        self.anchor_rowx, self.anchor_colx = to_rowcol(anchor, base = 0)
-
-        self.dataset = self.extract_dataframe(self.arr, self.anchor_rowx, self.anchor_colx).transpose()
-        self.equations = self.pop_equations()
-        self.check_dataset_after_equations()
-        self.var_to_rows = self.get_variable_locations_by_row()
-        self.model = MathModel(self.dataset, self.equations).set_xl_positioning(self.var_to_rows, anchor) 
+        """
+        self.varnames = list(varnames)
+        self.index = dict((v, i) for i, v in enumerate(self.varnames))
+        missing = [v for v in order if v not in self.index]
+        if missing:
+            raise KeyError("Variable without data: " + ", ".join(missing))
         
-        # update formulas on sheet
-        self.insert_formulas()
-    
-    def check_dataset_after_equations(self):
-
-        labs = list(self.dataset.columns)
-        dups = [x for x in labs if labs.count(x) > 1]
-        if len(dups) > 0:
-            self.echo_diagnostics()
-            raise ValueError("Duplicate labels: " + ", ".join(dups))            
+        self.refs = OrderedDict()
+        self.parts = OrderedDict()
+        for varname in order:
+            text, parts, refs = tokenize_equation(equations[varname], self.index)
+            for ref in refs:
+                if ref[0] not in self.index:
+                    raise KeyError("Variable without data: " + ref[0])
+            self.parts[varname], self.refs[varname] = parts, refs 
+            
+        # lags and leads define padding of time axis, so that any t+offset is in range 
+        offsets = [offset for refs in self.refs.values() for _, is_relative, offset in refs if is_relative]
+        self.pad_before = max([-x for x in offsets] + [0])
+        self.pad_after = max(offsets + [0])
+        
+        # dependent variables using other periods of dependent variables are stepped, 
+        # together with variables using them in same period 
+        self.stepped = set()
+        for varname in order:
+            for ref_var, is_relative, offset in self.refs[varname]:
+                if ref_var in self.refs and (ref_var in self.stepped or not is_relative or offset != 0):
+                    self.stepped.add(varname)
+        self.vectorized = [v for v in order if v not in self.stepped]
+        self.stepped = [v for v in order if v in self.stepped]
+        
+        self.code = dict((v, self._compile(v, stepped = v in self.stepped)) for v in order)
+        
+    def _compile(self, varname, stepped):
+        # equation compiled to expression over padded values array 'X' for period 't' or periods 'F'
+        # only numbers, operators, brackets and EVAL_FUNCTIONS pass into expression
+        pieces = self._literal(self.parts[varname][0])
+        for (ref_var, is_relative, offset), text in zip(self.refs[varname], self.parts[varname][1:]):
+            i = self.index[ref_var]
+            if is_relative:
+                time = ('t' if stepped else 'F') + '%+d' % (offset + self.pad_before) 
+            else:
+                # absolute period is based at 1  
+                p = offset - 1 + self.pad_before
+                time = str(p) if stepped else '%d:%d' % (p, p + 1)
+            pieces.append('X[:, %d, %s]' % (i, time))
+            pieces.extend(self._literal(text))
+        try:
+            expression = ' '.join(self._excel_precedence(pieces))
+        except IndexError:
+            raise ValueError("Cannot evaluate equation: " + varname)
+        return compile(expression, varname, 'eval')
     
-        if not 'is_forecast' in labs:
-            self.echo_diagnostics()
-            raise ValueError("Row 'is_forecast' not found in dataframe (possible reason - wrong anchor cell).")       
-                     
     @staticmethod
-    def extract_dataframe(arr, anchor_rowx, anchor_colx):
-        """Return a part of 'self.arr' starting anchor cell as dataframe.""" 
-           
-        data = arr[anchor_rowx:,anchor_colx:]
-        return pd.DataFrame(data=data[1:,1:],    # values
-                           index=data[1:, 0],    # 1st column as index
-                         columns=data[0 ,1:])    # 1st row as the column names
-
-    def get_variable_locations_by_row(self):
-        """Return dictionary with variable row locations.""" 
-        var_to_rows = {}
-        column_with_labels = self.arr[:,self.anchor_colx]
-        for rowx, label in enumerate(column_with_labels):
-            if label in self.dataset.columns:
-                # +1 to rebase from 0  
-                var_to_rows[label] = rowx + 1        
-        return var_to_rows  
+    def _literal(text):
+        pos = 0
+        pieces = []
+        while pos < len(text):
+            m = re.match(LITERAL_TOKEN_REGEX, text[pos:])
+            if not m:
+                raise ValueError("Cannot evaluate equation part: " + text)
+            token = m.group(1)
+            if token[0].isalpha() or token[0] == '_':
+                if token.upper() not in EVAL_FUNCTIONS:
+                    raise ValueError("Cannot evaluate function or name: " + token)
+                token = 'FUNCTIONS["%s"]' % token.upper()
+            pieces.append(token)
+            pos += m.end()
+        return pieces
         
-    def pop_equations(self):       
-        """Return list of strings containing equations. 
-           Also cleans out junk non-variable columns from self.dataset.""" 
-        equations = []        
+    @classmethod
+    def _excel_precedence(cls, tokens):
+        # Excel binds unary minus before ^ and computes ^ left to right: -2^2 is 4 and 2^3^2 is 64,
+        # operands of ^ and unary minus are put in brackets, so that Python ** gives same result
+        pieces = []
+        pos = 0
+        while pos < len(tokens):
+            if tokens[pos] in ('*', '/', '+', '-', ',') and pieces and pieces[-1] not in ('*', '/', '+', '-', ','):
+                # binary operator
+                pieces.append(tokens[pos])
+                pos += 1
+                continue
+            operand, pos = cls._operand(tokens, pos)
+            while pos < len(tokens) and tokens[pos] == '^':
+                exponent, pos = cls._operand(tokens, pos + 1)
+                operand = '(' + operand + ') ** ' + exponent
+            pieces.append(operand)
+        return pieces
         
-        def drop(label):
-            if label in self.dataset.columns:
-                self.dataset = self.dataset.drop(label, 1)
-                
-        for label in self.dataset.columns:
-            if "=" in label:
-                equations.append(label)
-                drop(label)
-            elif (" " in label.strip() 
-                  or label.startswith("#")
-                  or len(label) == 0):
-                drop(label)
-        return equations       
-
-    def insert_formulas(self):
-        """Populate formulas on array representing Excel sheet."""        
-        df = self.model.get_xl_dataset()
-        column_with_labels = self.arr[:,self.anchor_colx]
-        for rowx, label in enumerate(column_with_labels):
-            if label in df.columns:                
-                self.arr[rowx,self.anchor_colx+1:] = df[label].as_matrix()
-        return self
-
-    def save(self, filepath=None, sheet=None):
-        if not filepath:
-            filepath = self.source['path']            
-        if not sheet:
-            sheet = self.source['sheet']
-        self.target = {'path':filepath, 'sheet':sheet}
- 
-        write_array_to_sheet(filepath, sheet,  self.arr)
-        return self
+    @classmethod
+    def _operand(cls, tokens, pos):
+        # return text of number, reference, bracket, function call or signed operand starting at pos
+        token = tokens[pos]
+        if token in ('+', '-'):
+            operand, pos = cls._operand(tokens, pos + 1)
+            return '(' + token + operand + ')', pos
+        if token.startswith('FUNCTIONS['):
+            if tokens[pos + 1] != '(':
+                raise ValueError("Cannot evaluate function without brackets")
+            inner, pos = cls._operand(tokens, pos + 1)
+            return token + inner, pos
+        if token == '(':
+            depth, end = 1, pos + 1
+            while depth:
+                depth += {'(': 1, ')': -1}.get(tokens[end], 0)
+                end += 1
+            return '(' + ' '.join(cls._excel_precedence(tokens[pos + 1:end - 1])) + ')', end
+        if token in (')', ',', '*', '/', '^'):
+            raise ValueError("Cannot evaluate equation with operand missing before: " + token)
+        return token, pos + 1
         
-    def echo(self):
-        print("\nFile:\n    " + self.target['path'])
-        print(  "Sheet:\n    " + str(self.target['sheet'])) 
-        print("Updated formulas:")
-        eqs = ["    " + k + " = " + v  for k, v in self.model.equations.items()]
-        for e in eqs:
-            print(e)
-        return self
+    def run(self, values, is_forecast):
+        """
+        Fill forecast periods of dependent variables in *values* with equation results.
         
-    def echo_diagnostics(self):
-        print("File:\n    ", self.source['path'])
-        print("Sheet:\n    ", str(self.source['sheet']))            
-        print("Anchor row and column:\n    ", self.anchor_rowx, self.anchor_colx)             
-        print("Dataset columns:\n    ", self.dataset.columns) 
-    
-    
+        Parameters
+        ----------
+        values : float array of shape (scenarios, variables, periods)
+        is_forecast : sequence of 0 and 1 for each period 
         
-def cli():
-    """Command line interface to ExcelSheet(filepath, sheet, anchor).save()"""
+        Returns new array of same shape as *values*.
+        """
+        n, k, periods = values.shape
+        X = np.full((n, k, self.pad_before + periods + self.pad_after), np.nan)
+        X[:, :, self.pad_before:self.pad_before + periods] = values
+        forecast = np.flatnonzero(np.asarray(is_forecast) == 1)
+        namespace = {'FUNCTIONS': EVAL_FUNCTIONS, 'X': X, 'F': forecast}
+        
+        with np.errstate(all = 'ignore'):
+            for varname in self.vectorized:
+                X[:, self.index[varname], forecast + self.pad_before] = \
+                    eval(self.code[varname], {'__builtins__': {}}, namespace)
+            for t in forecast:
+                namespace['t'] = t
+                for varname in self.stepped:
+                    X[:, self.index[varname], t + self.pad_before] = \
+                        eval(self.code[varname], {'__builtins__': {}}, namespace)
+        return X[:, :, self.pad_before:self.pad_before + periods]
+        
+
+#----------------------------------------------------------------------------------
+#
+#    Sheet readers
+#
+#----------------------------------------------------------------------------------
+
+       
+def _read_value(value):
+    # force values type to 'int' where possible, 
+    # large floats stay floats, same as values not representable exactly  
+    if isinstance(value, float) and round(value) == value and abs(value) < 2**53:
+        return int(value)
+    return value
+
+def _is_empty(value):
+    return value is None or isinstance(value, str) and value == ''
+
+class CellStore():
+    """
+    Non-empty cells of a sheet by (rowx, colx), based at 0. Memory grows with the 
+    number of populated cells, not with the bounding box of the sheet. 
+    Empty cells read as '', same as in arrays from get_array_from_sheet().
     
-    parser = argparse.ArgumentParser(description='Command line interface to XlSheet(filename, sheet, anchor).save()',
-                                                           formatter_class=argparse.ArgumentDefaultsHelpFormatter)
-    parser.add_argument('filename',                        help='filename or path to .xls file')
-    parser.add_argument('sheet',  nargs='?', default=1,    help='sheet name or sheet index starting at 1')
-    parser.add_argument('anchor', nargs='?', default='A1', help='reference to upper-left corner of data block, defaults to A1')
+    Indexing
+    --------
+    store[rowx, colx] - one cell 
+    store[rowx, [colx, ...]] - several cells in a row, as array
+    Assigning '' or None removes cell.
+    
+    Methods
+    -------
+    .from_array(arr) - store with non-empty cells of 2D array  
+    .to_array(row_start, col_start, row_stop, col_stop) - dense 2D array of cells in window
+    .get_ranges() - (rowx, colx, values) rectangles with all cells, for writing 
+    .get_changed_ranges(old) - (rowx, colx, values) rectangles with cells that differ from *old*
+    
+    """
+    
+    def __init__(self, cells = None):
+        self.cells = {}
+        for (rowx, colx), value in (cells.items() if isinstance(cells, dict) else cells or []):
+            self._set(rowx, colx, value)
+        
+    @classmethod
+    def from_array(cls, arr):
+        arr = np.asarray(arr, dtype=object)
+        filled = ~np.frompyfunc(_is_empty, 1, 1)(arr).astype(bool)
+        return cls(((rowx, colx), arr[rowx, colx]) for rowx, colx in zip(*np.nonzero(filled)))
+        
+    @property
+    def shape(self):
+        """Number of rows and columns up to the last non-empty cell, same as shape of sheet array."""
+        if not self.cells:
+            return (0, 0)
+        return (max(rowx for rowx, colx in self.cells) + 1, max(colx for rowx, colx in self.cells) + 1)
+        
+    def __len__(self):
+        return len(self.cells)
+        
+    def items(self):
+        return self.cells.items()
+        
+    def copy(self):
+        other = CellStore()
+        other.cells = dict(self.cells)
+        return other
+        
+    def _set(self, rowx, colx, value):
+        if _is_empty(value):
+            self.cells.pop((int(rowx), int(colx)), None)
+        else:
+            self.cells[int(rowx), int(colx)] = value
+            
+    def __getitem__(self, key):
+        rowx, colx = key
+        if np.ndim(colx) == 0:
+            return self.cells.get((rowx, colx), '')
+        values = np.empty(len(colx), dtype=object)
+        values[:] = [self.cells.get((rowx, c), '') for c in colx]
+        return values
+    
+    def __setitem__(self, key, value):
+        rowx, colx = key
+        if np.ndim(colx) == 0:
+            self._set(rowx, colx, value)
+        else:
+            for c, v in zip(colx, value):
+                self._set(rowx, c, v)
+                
+    def to_array(self, row_start = 0, col_start = 0, row_stop = None, col_stop = None):
+        shape = self.shape
+        row_stop = shape[0] if row_stop is None else row_stop
+        col_stop = shape[1] if col_stop is None else col_stop
+        arr = np.empty((max(row_stop - row_start, 0), max(col_stop - col_start, 0)), dtype=object)
+        arr.fill('')
+        for (rowx, colx), value in self.cells.items():
+            if row_start <= rowx < row_stop and col_start <= colx < col_stop:
+                arr[rowx - row_start, colx - col_start] = value
+        return arr
+        
+    def _get_ranges(self, keys):
+        by_row = OrderedDict()
+        for rowx, colx in sorted(keys):
+            by_row.setdefault(rowx, []).append(colx)
+        get = self.cells.get
+        return [(top, first, [[get((rowx, colx), '') for colx in range(first, last + 1)] for rowx in range(top, bottom + 1)]) 
+                for (top, bottom), (first, last) in get_rectangles(by_row.items())]
+        
+    def get_ranges(self):
+        return self._get_ranges(self.cells.keys())
+        
+    def get_changed_ranges(self, old):
+        # memory grows with changed cells only
+        changed = [key for key, value in self.cells.items() if old.cells.get(key, '') != value]
+        changed.extend(key for key in old.cells if key not in self.cells)
+        return self._get_ranges(changed)
+            
+def _is_xlsx(filename):
+    return filename.lower().endswith(('.xlsx', '.xlsm'))
+
+class WorkbookReader():
+    """
+    Opens workbook once to read cell values of several sheets into arrays.
+    .xls files are read with xlrd, .xlsx files with streaming openpyxl reader.
+    Call .close() to release the file, it is reopened on next read if needed.  
+    
+    Methods
+    -------
+    .get_array(sheet, anchor) - return 2D array with cell values of *sheet*
+    .get_cells(sheet, anchor) - return CellStore with non-empty cells of *sheet* or of block at *anchor*
+    .close() - release the file 
+    
+    """
+    
+    def __init__(self, filepath):
+        self.filepath = filepath
+        self.book = None
+        
+    def _open(self):
+        if self.book is not None:
+            return self.book
+        if _is_xlsx(self.filepath):
+            try:
+                import openpyxl
+            except ImportError:
+                raise ImportError("openpyxl is required to read .xlsx files")
+            # read_only parses worksheet xml as stream, data_only gives values of formulas as xlrd does
+            self.book = openpyxl.load_workbook(self.filepath, read_only=True, data_only=True)
+        else:
+            # on_demand parses only requested sheets, xlrd reads the file through mmap 
+            import xlrd
+            self.book = xlrd.open_workbook(self.filepath, on_demand=True)
+        return self.book
+        
+    def close(self):
+        if self.book is None:
+            return
+        if _is_xlsx(self.filepath):
+            self.book.close()
+        else:
+            # loaded sheets stay usable, file is closed so that it can be written to 
+            self.book.release_resources()
+        self.book = None
+
+    def get_xlrd_sheet(self, sheet):
+        book = self._open()
+        if isinstance(sheet, int):
+            # if 'sheet' is integer, we assume 'sheet' is based at 1   
+            return book.sheet_by_index(sheet-1)
+        elif isinstance(sheet, str) and sheet in book.sheet_names():
+            return book.sheet_by_name(sheet)
+        else:
+            raise Exception("Cannot find sheet :" + str(sheet))
+    
+    def get_array(self, sheet, anchor = 'A1'):
+        """
+        Return 2D array with cell values of *sheet*. 
+        For .xlsx files only cells starting at *anchor* are read.
+        """
+        if _is_xlsx(self.filepath):
+            return self._get_xlsx_array(sheet, anchor)
+        else:
+            return self._get_xls_array(sheet)
+    
+    def get_cells(self, sheet, anchor = None):
+        """
+        Return CellStore with non-empty cells of *sheet*. If *anchor* is given only the block
+        at anchor is read: period labels in anchor row up to the last non-empty one and, within 
+        period columns, rows with a label below anchor, equation rows included. 
+        Memory is bounded by populated cells of the block, not by sheet size.
+        """
+        min_rowx, min_colx = (0, 0) if anchor is None else to_rowcol(anchor, base = 0)
+        cells = CellStore()
+        col_stop = None
+        for rowx, values in self._iter_rows(sheet, min_rowx, min_colx, labelled = anchor is not None):
+            if anchor is not None:
+                if col_stop is None:
+                    # anchor row holds period labels
+                    col_stop = max([j + 1 for j, value in enumerate(values) if not _is_empty(value)] + [1])
+                values = values[:col_stop]
+            for j, value in enumerate(values):
+                if not _is_empty(value):
+                    cells.cells[rowx, min_colx + j] = _read_value(value)
+        return cells
+    
+    def _iter_rows(self, sheet, min_rowx, min_colx, labelled = False):
+        # yields (rowx, values starting at min_colx) for rows from min_rowx, 
+        # if *labelled* is True rows after first one are skipped if their first cell is empty
+        if _is_xlsx(self.filepath):
+            ws = self._get_openpyxl_sheet(sheet)
+            for i, values in enumerate(ws.iter_rows(min_row = min_rowx + 1, min_col = min_colx + 1, values_only = True)):
+                if i == 0 or not labelled or (values and not _is_empty(values[0])):
+                    yield min_rowx + i, values
+        else:
+            ws = self.get_xlrd_sheet(sheet)
+            for rowx in range(min_rowx, ws.nrows):
+                if (rowx == min_rowx or not labelled or 
+                        min_colx < ws.row_len(rowx) and not _is_empty(ws.cell_value(rowx, min_colx))):
+                    yield rowx, ws.row_values(rowx, min_colx)
+    
+    def _get_openpyxl_sheet(self, sheet):
+        book = self._open()
+        if isinstance(sheet, int):
+            # if 'sheet' is integer, we assume 'sheet' is based at 1   
+            return book.worksheets[sheet-1]
+        elif isinstance(sheet, str) and sheet in book.sheetnames:
+            return book[sheet]
+        else:
+            raise Exception("Cannot find sheet :" + str(sheet))
+    
+    def _get_xls_array(self, sheet):
+        import xlrd
+        sheet = self.get_xlrd_sheet(sheet)       
+        array = np.empty((sheet.nrows,sheet.ncols), dtype=object)
+        array.fill('')
+        for row in range(sheet.nrows):
+            values = sheet.row_values(row)
+            array[row, :len(values)] = values
+            # force values type to 'int' where possible
+            types = np.asarray(sheet.row_types(row), dtype=np.uint8)
+            cols = np.flatnonzero((types == xlrd.XL_CELL_NUMBER) | (types == xlrd.XL_CELL_DATE))
+            if len(cols):
+                numbers = array[row, cols].astype(float)
+                # large floats stay floats, same as values not representable exactly  
+                cols = cols[(np.round(numbers) == numbers) & (np.abs(numbers) < 2**53)]
+                array[row, cols] = array[row, cols].astype(np.int64)
+        return array              
+
+    def _get_xlsx_array(self, sheet, anchor = 'A1'):
+        # only rows and columns starting at *anchor* are materialized, 
+        # cells above and to the left of anchor are left empty  
+        ws = self._get_openpyxl_sheet(sheet)
+        min_row, min_col = to_rowcol(anchor)
+        rows = [row for row in ws.iter_rows(min_row=min_row, min_col=min_col, values_only=True)]
+            
+        # trailing empty rows and columns are not part of sheet, same as in xlrd
+        while rows and all(v is None for v in rows[-1]):
+            rows.pop()
+        ncols = max([max([j + 1 for j, v in enumerate(row) if v is not None] + [0]) for row in rows] + [0])
+        array = np.empty((min_row - 1 + len(rows), min_col - 1 + ncols if ncols else 0), dtype=object)
+        array.fill('')
+        for i, row in enumerate(rows):
+            for j, value in enumerate(row[:ncols]):
+                if value is None:
+                    continue
+                array[min_row - 1 + i, min_col - 1 + j] = _read_value(value)
+        return array
+
+def _get_xlrd_sheet(filename, sheet):
+    reader = WorkbookReader(filename)
+    try:
+        return reader.get_xlrd_sheet(sheet)
+    finally:
+        reader.close()
+       
+def get_array_from_sheet(filename, sheet, anchor = 'A1'):
+    """
+    Return 2D array with cell values of *sheet* in *filename*. 
+    For .xlsx files only cells starting at *anchor* are read.
+    """
+    reader = WorkbookReader(filename)
+    try:
+        return reader.get_array(sheet, anchor)
+    finally:
+        reader.close()
+
+def get_cells_from_sheet(filename, sheet, anchor = None):
+    """
+    Return CellStore with non-empty cells of *sheet* in *filename*. 
+    If *anchor* is given only the block at anchor is read, see WorkbookReader.get_cells().
+    """
+    reader = WorkbookReader(filename)
+    try:
+        return reader.get_cells(sheet, anchor)
+    finally:
+        reader.close()
+
+#----------------------------------------------------------------------------------
+#
+#    Workbook writers
+#
+#----------------------------------------------------------------------------------
+
+# from 'RC[-1]*R[1]C+R[2]C4' catches ('', '[-1]'), ('[1]', ''), ('[2]', '4')
+R1C1_REGEX = r'(?<![A-Za-z_])R(\[-?\d+\]|\d*)C(\[-?\d+\]|\d*)(?![A-Za-z_(])'
+
+def r1c1_to_a1(formula, row, col):
+    """Convert R1C1-style *formula* to A1-style formula for cell at *row*, *col* (based at 1)."""
+    
+    def a1_part(part, base):
+        if part.startswith('['):
+            return base + int(part[1:-1])
+        elif part:
+            return int(part)
+        else:
+            return base
+    
+    def replace(m):
+        r, c = m.groups()
+        return to_xl_ref(a1_part(r, row), a1_part(c, col))
+    
+    return re.sub(R1C1_REGEX, replace, formula)
+
+def _fullpath(path):
+    
+    # current directory
+    cur_dir = os.path.dirname(os.path.abspath(__file__))
+
+    if os.path.normcase(os.path.normpath(path)).startswith(cur_dir):
+       return path
+    else:
+       return os.path.join(cur_dir, path)
+
+class SheetWriter():
+    """
+    Base class for writing cell values and formulas to an existing workbook.
+    Strings starting with '=' are written as formulas. Nothing is stored 
+    to disk until .save() is called.
+    
+    Methods
+    -------
+    .write_range(sheet, rowx, colx, values) - write 2D block of values with upper-left cell at (rowx, colx), based at 0
+    .write_r1c1_range(sheet, row, first_col, last_col, formula) - write R1C1 formula to cells in row, based at 1
+    .write_array(sheet, arr) - write 2D block of values starting at cell A1
+    .save() - save workbook
+    
+    """
+    
+    def __init__(self, filepath):
+        if not os.path.exists(filepath):
+            raise FileNotFoundError(filepath)
+        self.filepath = filepath
+
+    def write_array(self, sheet, arr):
+        self.write_range(sheet, 0, 0, arr)
+        
+    def write_range(self, sheet, rowx, colx, values):
+        raise NotImplementedError
+        
+    def write_r1c1_range(self, sheet, row, first_col, last_col, formula):
+        # default is cell by cell, backends with native R1C1 support override this 
+        for col in range(first_col, last_col + 1):
+            self.write_range(sheet, row - 1, col - 1, [[r1c1_to_a1(formula, row, col)]])
+    
+    def save(self):
+        raise NotImplementedError
+
+    @staticmethod
+    def _cell_value(value):
+        # numpy scalars to python types, nan to empty cell 
+        if hasattr(value, 'item'):
+            value = value.item()
+        if isinstance(value, float) and value != value:
+            value = None
+        return value
+
+class XlwingsWriter(SheetWriter):
+    """Writes through running Microsoft Excel instance, requires Windows and xlwings."""
+    
+    def __init__(self, filepath):
+        from xlwings import Workbook 
+        path = _fullpath(filepath) # Workbook(path) seems to fail unless full path is provided
+        SheetWriter.__init__(self, path)
+        self.wb = Workbook(path)
+
+    def _activate(self, sheet):
+        from xlwings import Sheet
+        Sheet(sheet).activate()
+        
+    def write_range(self, sheet, rowx, colx, values):
+        from xlwings import Range
+        self._activate(sheet)
+        Range((rowx + 1, colx + 1)).value = values 
+
+    def write_r1c1_range(self, sheet, row, first_col, last_col, formula):
+        from xlwings import Range
+        self._activate(sheet)
+        Range((row, first_col), (row, last_col)).api.FormulaR1C1 = formula 
+        
+    def save(self):
+        self.wb.save()
+        
+class XlsFileWriter(SheetWriter):
+    """
+    Writes .xls file without Excel, requires xlwt and xlutils. 
+    Other sheets and cell formatting are preserved, but the book is rebuilt from 
+    values read by xlrd: formulas not written by this writer become their last 
+    computed values (empty if never computed by Excel), charts and names are lost.
+    Never chosen by backend 'auto', use backend 'file' explicitly.
+    """
+    
+    def __init__(self, filepath):
+        try:
+            from xlutils.copy import copy
+        except ImportError:
+            raise ImportError("xlwt and xlutils are required to write .xls files without Excel")
+        import warnings
+        import xlrd
+        warnings.warn("Writing .xls without Excel: existing formulas in " + filepath + 
+                      " are replaced by their computed values, charts and names are lost")
+        SheetWriter.__init__(self, filepath)
+        book = xlrd.open_workbook(filepath, formatting_info=True, on_demand=True)
+        self.sheet_names = book.sheet_names()
+        self.wb = copy(book)
+        book.release_resources()
+        
+    def _get_sheet(self, sheet):
+        if isinstance(sheet, int):
+            # if 'sheet' is integer, we assume 'sheet' is based at 1   
+            return self.wb.get_sheet(sheet - 1)
+        elif sheet in self.sheet_names:
+            return self.wb.get_sheet(self.sheet_names.index(sheet))
+        else:
+            raise Exception("Cannot find sheet :" + str(sheet))
+        
+    def write_range(self, sheet, rowx, colx, values):
+        import xlwt
+        ws = self._get_sheet(sheet)
+        for i, row_values in enumerate(values):
+            row = ws.row(rowx + i)
+            # xlwt Row keeps cells in private dictionary, used to preserve cell formatting
+            cells = row._Row__cells
+            for j, value in enumerate(row_values):
+                value = self._cell_value(value)
+                if isinstance(value, str) and value.startswith('='):
+                    value = xlwt.Formula(value[1:])
+                previous = cells.get(colx + j)
+                if previous is None and value in ('', None):
+                    continue
+                row.write(colx + j, value)
+                if previous is not None:
+                    cells[colx + j].xf_idx = previous.xf_idx
+        
+    def save(self):
+        self.wb.save(self.filepath)
+
+def _get_shared_formula_type():
+    # openpyxl writes attributes of ArrayFormula cells as given, subclass makes them shared formula: 
+    # first cell holds formula and range, other cells only refer to it by index 'si'
+    from openpyxl.worksheet.formula import ArrayFormula
+    
+    class SharedFormula(ArrayFormula):
+        t = 'shared'
+        
+        def __init__(self, si, ref = None, text = None):
+            ArrayFormula.__init__(self, ref, text)
+            self.si = si
+            
+        def __iter__(self):
+            yield 't', self.t
+            if self.ref:
+                yield 'ref', self.ref
+            yield 'si', str(self.si)
+            
+    return SharedFormula
+
+class XlsxFileWriter(SheetWriter):
+    """
+    Writes .xlsx file without Excel, requires openpyxl. 
+    Other sheets and cell formatting are preserved. 
+    R1C1 ranges are written as shared formulas, formula text is stored once per range.
+    """
+    
+    def __init__(self, filepath):
+        try:
+            import openpyxl
+        except ImportError:
+            raise ImportError("openpyxl is required to write .xlsx files without Excel")
+        SheetWriter.__init__(self, filepath)
+        self.wb = openpyxl.load_workbook(filepath, keep_vba=filepath.lower().endswith('.xlsm'))
+        # openpyxl expands shared formulas of loaded book, so indices of new ones start at 0 
+        self._shared_count = {}
+        self._shared_formula = _get_shared_formula_type()
+        
+    def _get_sheet(self, sheet):
+        if isinstance(sheet, int):
+            # if 'sheet' is integer, we assume 'sheet' is based at 1   
+            return self.wb.worksheets[sheet - 1]
+        elif sheet in self.wb.sheetnames:
+            return self.wb[sheet]
+        else:
+            raise Exception("Cannot find sheet :" + str(sheet))
+        
+    def write_range(self, sheet, rowx, colx, values):
+        ws = self._get_sheet(sheet)
+        for i, row_values in enumerate(values):
+            for j, value in enumerate(row_values):
+                value = self._cell_value(value)
+                ws.cell(row=rowx + i + 1, column=colx + j + 1).value = None if value == '' else value
+                
+    def write_r1c1_range(self, sheet, row, first_col, last_col, formula):
+        ws = self._get_sheet(sheet)
+        si = self._shared_count.get(ws.title, 0)
+        self._shared_count[ws.title] = si + 1
+        ref = to_xl_ref(row, first_col) + ':' + to_xl_ref(row, last_col)
+        ws.cell(row=row, column=first_col).value = self._shared_formula(si, ref, r1c1_to_a1(formula, row, first_col))
+        for col in range(first_col + 1, last_col + 1):
+            ws.cell(row=row, column=col).value = self._shared_formula(si)
+        
+    def save(self):
+        self.wb.save(self.filepath)
+
+# 'auto' uses Excel through xlwings on Windows if available, file writers otherwise
+WRITER_BACKENDS = ['auto', 'xlwings', 'file']
+
+def get_writer(filepath, backend='auto'):
+    """
+    Return SheetWriter for *filepath*, *backend* is one of WRITER_BACKENDS.
+    Backend 'auto' uses Excel through xlwings where available, otherwise writes .xlsx files directly.  
+    It refuses .xls files without Excel, as XlsFileWriter does not keep formulas of the workbook.
+    """
+    if backend not in WRITER_BACKENDS:
+        raise ValueError("Unknown writer backend: " + str(backend))
+    if backend == 'auto':
+        if sys.platform == 'win32' and _has_module('xlwings'):
+            backend = 'xlwings'
+        elif _is_xlsx(filepath):
+            backend = 'file'
+        else:
+            raise ValueError("Cannot write .xls file without Excel and keep its formulas: " + filepath + 
+                             ". Use backend 'file' to write it anyway, other formulas become values.")
+    if backend == 'xlwings':
+        return XlwingsWriter(filepath)
+    elif _is_xlsx(filepath):
+        return XlsxFileWriter(filepath)
+    else:
+        return XlsFileWriter(filepath)
+
+def _has_module(name):
+    import importlib.util
+    return importlib.util.find_spec(name) is not None
+
+def write_array_to_sheet(filepath, sheet, arr, backend='auto'):
+    writer = get_writer(filepath, backend)
+    writer.write_array(sheet, arr)
+    writer.save()
+
+def write_r1c1_ranges_to_sheet(filepath, sheet, ranges, backend='auto'):
+    """Write each (row, first_col, last_col, formula) range with a single R1C1 formula assignment."""
+    writer = get_writer(filepath, backend)
+    for row, first_col, last_col, formula in ranges:
+        writer.write_r1c1_range(sheet, row, first_col, last_col, formula)
+    writer.save()
+
+def write_workbook(filepath, sheets, backend='auto'):
+    """
+    Create new workbook *filepath* from *sheets*, dictionary of sheet name to 2D array of cell 
+    values starting at A1. Each sheet is written in one bulk operation, existing file is replaced. 
+    Backend 'auto' uses Excel through xlwings where available, otherwise writes file directly.
+    """
+    if backend not in WRITER_BACKENDS:
+        raise ValueError("Unknown writer backend: " + str(backend))
+    if backend == 'auto':
+        backend = 'xlwings' if sys.platform == 'win32' and _has_module('xlwings') else 'file'
+    rows_by_sheet = OrderedDict()
+    for name, arr in sheets.items():
+        rows_by_sheet[name] = [[None if _is_empty(value) else value for value in map(SheetWriter._cell_value, row)] 
+                               for row in np.asarray(arr, dtype=object).tolist()]
+    
+    if backend == 'xlwings':
+        from xlwings import Workbook, Sheet, Range
+        wb = Workbook()
+        for i, (name, rows) in enumerate(rows_by_sheet.items()):
+            if i < Sheet.count():
+                Sheet(i + 1).name = name
+            else:
+                Sheet.add(name, after = Sheet.count())
+            if rows:
+                Range(name, 'A1').value = rows
+        wb.save(_fullpath(filepath))
+    elif _is_xlsx(filepath):
+        try:
+            import openpyxl
+        except ImportError:
+            raise ImportError("openpyxl is required to write .xlsx files without Excel")
+        # write-only workbook streams rows to file  
+        wb = openpyxl.Workbook(write_only = True)
+        for name, rows in rows_by_sheet.items():
+            ws = wb.create_sheet(name)
+            for row in rows:
+                ws.append(row)
+        wb.save(filepath)
+    else:
+        try:
+            import xlwt
+        except ImportError:
+            raise ImportError("xlwt is required to write .xls files without Excel")
+        wb = xlwt.Workbook()
+        for name, rows in rows_by_sheet.items():
+            ws = wb.add_sheet(name)
+            for rowx, row in enumerate(rows):
+                for colx, value in enumerate(row):
+                    if value is None:
+                        continue
+                    if isinstance(value, str) and value.startswith('='):
+                        value = xlwt.Formula(value[1:])
+                    ws.write(rowx, colx, value)
+        wb.save(filepath)
+   
+   
+#----------------------------------------------------------------------------------
+#
+#    Sheet layout
+#
+#----------------------------------------------------------------------------------
+
+class SheetLayout():
+    """
+    Index of text cells on sheet and bounds of data blocks, built in one scan of array. 
+    
+    A block spans rows from its anchor down to the next block anchored in the same 
+    column and columns up to the next block on the right overlapping its rows. 
+    With one block it spans the whole sheet. Labels and rows of each block are held 
+    in dictionaries for constant time lookup.
+    
+    Parameters
+    ----------
+    arr : array or CellStore with cell values of the sheet
+    anchors : A1 references of blocks on sheet, if None blocks are found by 'is_forecast' 
+              labels: anchor is the cell above 'is_forecast' label 
+    
+    Methods
+    -------
+    .get_anchors() - list of A1 references of blocks 
+    .get_bounds(anchor_rowx, anchor_colx) - (row_stop, col_stop) of block, based at 0, not inclusive 
+    .get_labels(anchor_rowx, anchor_colx) - dictionary of label to row of block, based at 0
+    
+    """
+    
+    def __init__(self, arr, anchors = None):
+        self.shape = arr.shape
+        # label -> list of (rowx, colx), colx -> list of (rowx, label) 
+        self.cells = {}
+        self.columns = {}
+        if isinstance(arr, CellStore):
+            text = sorted(key for key, value in arr.items() if isinstance(value, str))
+        else:
+            is_text = np.frompyfunc(lambda v: isinstance(v, str) and v != '', 1, 1)(arr).astype(bool)
+            text = zip(*np.nonzero(is_text))
+        for rowx, colx in text:
+            rowx, colx = int(rowx), int(colx)
+            label = arr[rowx, colx]
+            self.cells.setdefault(label, []).append((rowx, colx))
+            self.columns.setdefault(colx, []).append((rowx, label))
+        if anchors is None:
+            self.anchors = sorted((rowx - 1, colx) for rowx, colx in self.cells.get('is_forecast', []) if rowx > 0)
+        else:
+            self.anchors = sorted(set(to_rowcol(anchor, base = 0) for anchor in anchors))
+        self._row_stops = dict((anchor, self._get_row_stop(*anchor)) for anchor in self.anchors)
+        self._bounds = {}
+        self._labels = {}
+    
+    def get_anchors(self):
+        return [to_xl_ref(rowx, colx, base = 0) for rowx, colx in self.anchors]
+        
+    def _get_row_stop(self, anchor_rowx, anchor_colx):
+        below = [rowx for rowx, colx in self.anchors if colx == anchor_colx and rowx > anchor_rowx]
+        return min(below + [self.shape[0]])
+        
+    def get_bounds(self, anchor_rowx, anchor_colx):
+        key = (anchor_rowx, anchor_colx)
+        if key not in self._bounds:
+            row_stop = self._get_row_stop(anchor_rowx, anchor_colx)
+            right = [colx for rowx, colx in self.anchors 
+                     if colx > anchor_colx and rowx < row_stop and self._row_stops[rowx, colx] > anchor_rowx]
+            self._bounds[key] = row_stop, min(right + [self.shape[1]])
+        return self._bounds[key]
+        
+    def get_labels(self, anchor_rowx, anchor_colx):
+        key = (anchor_rowx, anchor_colx)
+        if key not in self._labels:
+            row_stop = self.get_bounds(anchor_rowx, anchor_colx)[0]
+            self._labels[key] = dict((label, rowx) for rowx, label in self.columns.get(anchor_colx, []) 
+                                     if anchor_rowx < rowx < row_stop)
+        return self._labels[key]
+        
+
+#----------------------------------------------------------------------------------
+#
+#    Formula cache
+#
+#----------------------------------------------------------------------------------
+
+# change when formula generation changes, so that old cache entries are not used 
+CACHE_VERSION = 1
+
+def get_default_cache_dir():
+    return os.environ.get('XLMODEL_CACHE_DIR', 
+                          os.path.join(os.path.expanduser('~'), '.cache', 'xlmodel'))
+
+def get_file_stamp(filepath):
+    """Return [modification time, size] of file, used to check file was not changed after writing."""
+    stat = os.stat(filepath)
+    return [stat.st_mtime_ns, stat.st_size]
+
+class FormulaCache():
+    """
+    On-disk cache of formula cells generated for a model, keyed by hash of 
+    model inputs (see ExcelSheet.get_model_hash()). Each entry also remembers 
+    files and sheets it was written to, so that writing can be skipped if the 
+    file was not changed since. Least recently used entries are removed when 
+    total size exceeds *max_bytes*.
+    
+    Methods
+    -------
+    .get(key) - return list of (rowx, colx, formula) or None 
+    .put(key, cells) - store cells 
+    .is_written(key, filepath, sheet) - True if cells were written to unchanged file
+    .mark_written(key, filepath, sheet) - remember cells were written to file
+    .clear() - remove all entries
+    
+    """
+    
+    def __init__(self, directory = None, max_bytes = 100 * 2**20):
+        self.directory = directory or get_default_cache_dir()
+        self.max_bytes = max_bytes
+        # running estimate of directory size, counted from files on first write
+        self._size = None
+        
+    def _path(self, key):
+        return os.path.join(self.directory, key + '.json')
+        
+    def _load(self, key):
+        try:
+            with open(self._path(key)) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+            
+    def _dump(self, key, entry):
+        os.makedirs(self.directory, exist_ok = True)
+        # write to temporary file and rename, so that parallel processes never read half-written entry
+        tmp_path = self._path(key) + '.%d.tmp' % os.getpid()
+        with open(tmp_path, 'w') as f:
+            json.dump(entry, f)
+        os.replace(tmp_path, self._path(key))
+        if self._size is None:
+            self._size = sum(size for _, size, _ in self._entries())
+        else:
+            # replaced entry is counted twice, this only makes eviction earlier
+            self._size += os.path.getsize(self._path(key))
+        if self._size > self.max_bytes:
+            self._evict()
+        
+    def get(self, key):
+        entry = self._load(key)
+        if entry is None:
+            return None
+        # modification time of entry file is its last use, other process may have evicted it
+        try:
+            os.utime(self._path(key))
+        except FileNotFoundError:
+            pass
+        return [tuple(cell) for cell in entry['cells']]
+        
+    def put(self, key, cells):
+        self._dump(key, {'cells': [list(cell) for cell in cells], 'written': {}})
+        
+    @staticmethod
+    def _target(filepath, sheet):
+        return os.path.abspath(filepath) + '|' + str(sheet)
+        
+    def is_written(self, key, filepath, sheet):
+        entry = self._load(key)
+        if entry is None or not os.path.exists(filepath):
+            return False
+        return entry['written'].get(self._target(filepath, sheet)) == get_file_stamp(filepath)
+        
+    def mark_written(self, key, filepath, sheet):
+        entry = self._load(key)
+        if entry is not None:
+            entry['written'][self._target(filepath, sheet)] = get_file_stamp(filepath)
+            self._dump(key, entry)
+    
+    def _entries(self):
+        if not os.path.isdir(self.directory):
+            return []
+        entries = []
+        for f in os.listdir(self.directory):
+            if f.endswith('.json'):
+                path = os.path.join(self.directory, f)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    # removed by other process sharing the directory 
+                    continue
+                entries.append((stat.st_mtime_ns, stat.st_size, path))
+        return entries
+        
+    @staticmethod
+    def _remove(path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        
+    def _evict(self):
+        entries = sorted(self._entries())
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            self._remove(path)
+            total -= size
+        self._size = total
+            
+    def clear(self):
+        for _, _, path in self._entries():
+            self._remove(path)
+        self._size = 0
+        
+
+#----------------------------------------------------------------------------------
+#
+#    Model snapshot
+#
+#----------------------------------------------------------------------------------
+
+SNAPSHOT_EXTENSION = '.xlsnap'
+SNAPSHOT_MAGIC = b'XLMSNAP1'
+# arrays in snapshot file start at multiples of this many bytes 
+SNAPSHOT_ALIGN = 64
+
+# kinds of dataset cells in snapshot: number in values array, other values in header 
+EMPTY_CELL, INT_CELL, FLOAT_CELL, HEADER_CELL = 0, 1, 2, 3
+
+def _snapshot_default(value):
+    # JSON encoding of header values that are not JSON types 
+    import datetime
+    if isinstance(value, (datetime.date, datetime.time)):
+        return {'__isoformat__': value.isoformat(), 'type': type(value).__name__}
+    if hasattr(value, 'item'):
+        return value.item()
+    raise TypeError("Cannot store in snapshot: " + repr(value))
+    
+def _snapshot_object_hook(obj):
+    import datetime
+    if '__isoformat__' in obj:
+        return getattr(datetime, obj['type']).fromisoformat(obj['__isoformat__'])
+    return obj
+
+class ModelSnapshot():
+    """
+    Parsed model in compact binary file, loaded back without reading the workbook.
+    
+    File holds magic bytes, length of JSON header, the header (labels, periods, equations, 
+    variable rows, anchor, source sheet and non-numeric cells) and two aligned arrays 
+    of shape (variables, periods): float64 values and int8 kinds of cells. Arrays are 
+    memory-mapped on load.
+    
+    Methods
+    -------
+    .from_sheet(xl), .from_model(model, source) - snapshot of ExcelSheet or MathModel
+    .save(path) - write snapshot file, extension '.xlsnap' is suggested
+    .load(path) - read snapshot file
+    .get_model() - MathModel with variable rows and anchor
+    .write_formulas(filepath, sheet, backend) - write formulas to source or other workbook 
+    
+    """
+    
+    def __init__(self, data, equations, var_to_rows, anchor = 'A1', source = None):
+        """
+        Parameters
+        ----------
+        data : Dataset with 'is_forecast' variable
+        equations : list of equation strings
+        var_to_rows : dictionary of variable name to row on sheet, based at 1 
+        anchor : A1 reference of upper-left cell of the block
+        source : dictionary with 'path' and 'sheet' of the workbook, or None 
+        """
+        self.data = data
+        self.equations = list(equations)
+        self.var_to_rows = dict(var_to_rows)
+        self.anchor = anchor
+        self.source = source
+        # workbook and sheet of last write_formulas()
+        self.target = None
+        
+    @classmethod
+    def from_sheet(cls, xl):
+        source = {'path': os.path.abspath(xl.source['path']), 'sheet': xl.source['sheet']}
+        return cls(xl.data, xl.equations, xl.var_to_rows, xl.source['anchor'], source)
+        
+    @classmethod
+    def from_model(cls, model, source = None):
+        equations = [varname + ' = ' + equation for varname, equation in model.equations.items()]
+        return cls(model.data, equations, model.var_to_rows, model.anchor, source)
+        
+    def _encode_values(self):
+        import numbers
+        shape = self.data.values.shape
+        values = np.full(shape, np.nan)
+        kinds = np.zeros(shape, dtype=np.int8)
+        cells = []
+        for (i, j), value in np.ndenumerate(self.data.values):
+            if isinstance(value, str) and value == '':
+                continue
+            if isinstance(value, numbers.Integral) and not isinstance(value, (bool, np.bool_)) and abs(value) < 2**53:
+                values[i, j], kinds[i, j] = value, INT_CELL
+            elif isinstance(value, float):
+                values[i, j], kinds[i, j] = value, FLOAT_CELL
+            else:
+                kinds[i, j] = HEADER_CELL
+                cells.append([i, j, value])
+        return values, kinds, cells
+        
+    def save(self, path):
+        values, kinds, cells = self._encode_values()
+        header = {'version': 1, 'labels': self.data.labels, 'periods': self.data.periods, 
+                  'equations': self.equations, 'var_to_rows': self.var_to_rows, 
+                  'anchor': self.anchor, 'source': self.source, 'cells': cells, 
+                  'shape': list(values.shape)}
+        text = json.dumps(header, default = _snapshot_default).encode('utf-8')
+        start = len(SNAPSHOT_MAGIC) + 8 + len(text)
+        with open(path, 'wb') as f:
+            f.write(SNAPSHOT_MAGIC)
+            f.write(len(text).to_bytes(8, 'little'))
+            f.write(text)
+            for arr in [values, kinds]:
+                f.write(b'\0' * (-start % SNAPSHOT_ALIGN))
+                start += -start % SNAPSHOT_ALIGN
+                f.write(arr.tobytes())
+                start += arr.nbytes
+        return self
+    
+    @classmethod
+    def load(cls, path, mmap = True):
+        """Read snapshot from *path*, numeric arrays are memory-mapped if *mmap* is True."""
+        with open(path, 'rb') as f:
+            if f.read(len(SNAPSHOT_MAGIC)) != SNAPSHOT_MAGIC:
+                raise ValueError("Not a model snapshot: " + str(path))
+            size = int.from_bytes(f.read(8), 'little')
+            header = json.loads(f.read(size).decode('utf-8'), object_hook = _snapshot_object_hook)
+        shape = tuple(header['shape'])
+        start = len(SNAPSHOT_MAGIC) + 8 + size
+        arrays = []
+        for dtype in [np.float64, np.int8]:
+            start += -start % SNAPSHOT_ALIGN
+            count = int(np.prod(shape))
+            if mmap and count:
+                arrays.append(np.memmap(path, dtype = dtype, mode = 'r', offset = start, shape = shape))
+            else:
+                arrays.append(np.fromfile(path, dtype = dtype, count = count, offset = start).reshape(shape))
+            start += count * np.dtype(dtype).itemsize
+        values, kinds = arrays
+        
+        # cell values as read from sheet: ints, floats, '' for empty cells and values from header 
+        cells = values.astype(object)
+        is_int = kinds == INT_CELL
+        cells[is_int] = values[is_int].astype(np.int64).tolist()
+        cells[kinds == EMPTY_CELL] = ''
+        for i, j, value in header['cells']:
+            cells[i, j] = value
+        del arrays, values, kinds
+        return cls(Dataset(header['labels'], header['periods'], cells), header['equations'], 
+                   header['var_to_rows'], header['anchor'], header['source'])
+                   
+    def get_model(self):
+        return MathModel(self.data, self.equations).set_xl_positioning(self.var_to_rows, self.anchor)
+        
+    def write_formulas(self, filepath = None, sheet = None, backend = 'auto', chunk_size = 100):
+        """
+        Write formulas to *filepath* and *sheet*, defaults to source of snapshot. Other cells are not 
+        written, workbook must have the model block at same place as when snapshot was taken.
+        Formulas are generated *chunk_size* forecast periods at a time. Returns MathModel.
+        """
+        source = self.source or {}
+        filepath = filepath or source.get('path')
+        sheet = sheet or source.get('sheet')
+        if filepath is None or sheet is None:
+            raise ValueError("Snapshot has no source workbook, give filepath and sheet")
+        self.target = {'path': filepath, 'sheet': sheet}
+        model = self.get_model()
+        writer = get_writer(filepath, backend)
+        for rowx, colx, values in model.iter_formula_ranges(chunk_size):
+            writer.write_range(sheet, rowx, colx, values)
+        writer.save()
+        return model
+        
+    def echo(self):
+        target = self.target or self.source or {}
+        print("\nFile:\n    " + str(target.get('path')))
+        print(  "Sheet:\n    " + str(target.get('sheet'))) 
+        print("Formulas from snapshot:")
+        for equation in self.equations:
+            print("    " + equation)
+        return self
+
+
+#----------------------------------------------------------------------------------
+#
+#    Profiling
+#
+#----------------------------------------------------------------------------------
+
+class Profiler():
+    """
+    Record wall time, number of calls and peak memory of named phases.
+    Phases may be nested, peak memory of inner phase counts in outer phase too.
+    
+    Parameters
+    ----------
+    memory : trace peak memory with tracemalloc, slows down Python code while tracing 
+    callback : function(name, seconds, peak_bytes) called after each phase, e.g. to send metrics
+    
+    Methods
+    -------
+    .phase(name) - context manager timing one call of phase *name*
+    .to_dict() - dictionary of phase name to {'seconds', 'calls', 'peak_bytes'}
+    .echo() - print table of phases
+    
+    """
+    
+    def __init__(self, memory = True, callback = None):
+        self.memory = memory
+        self.callback = callback
+        self.phases = OrderedDict()
+        # [memory at phase start, highest peak seen in phase, traced peak at phase start] 
+        # for phases entered and not exited
+        self._stack = []
+        # tracemalloc started by profiler, otherwise tracing belongs to caller and is left as it is 
+        self._owns_tracing = False
+        
+    @contextlib.contextmanager
+    def phase(self, name):
+        import tracemalloc
+        if self.memory and not self._stack and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._owns_tracing = True
+        tracing = self.memory and tracemalloc.is_tracing()
+        if tracing:
+            current, peak = tracemalloc.get_traced_memory()
+            if self._owns_tracing:
+                if self._stack:
+                    self._stack[-1][1] = max(self._stack[-1][1], peak)
+                tracemalloc.reset_peak()
+                peak = current
+            self._stack.append([current, current, peak])
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            peak_bytes = None
+            if tracing:
+                start_memory, highest, start_peak = self._stack.pop()
+                current, peak = tracemalloc.get_traced_memory()
+                # peak is not reset under caller's tracing, it counts only if it rose during phase
+                highest = max(highest, current, peak if peak > start_peak else 0)
+                peak_bytes = highest - start_memory
+                if self._stack:
+                    self._stack[-1][1] = max(self._stack[-1][1], highest)
+                elif self._owns_tracing:
+                    tracemalloc.stop()
+                    self._owns_tracing = False
+            stats = self.phases.setdefault(name, {'seconds': 0.0, 'calls': 0, 'peak_bytes': None})
+            stats['seconds'] += seconds
+            stats['calls'] += 1
+            if peak_bytes is not None:
+                stats['peak_bytes'] = max(stats['peak_bytes'] or 0, peak_bytes)
+            if self.callback is not None:
+                self.callback(name, seconds, peak_bytes)
+                
+    def to_dict(self):
+        return OrderedDict((name, dict(stats)) for name, stats in self.phases.items())
+        
+    def echo(self):
+        print("Phases:")
+        for name, stats in self.phases.items():
+            memory = "" if stats['peak_bytes'] is None else "%8.1f MB peak" % (stats['peak_bytes'] / 2**20)
+            print("    %-10s %8.3f s %5d calls %s" % (name, stats['seconds'], stats['calls'], memory))
+        return self
+        
+def _phase(profiler, name):
+    """Context manager timing phase *name* with *profiler*, does nothing if profiler is None."""
+    if profiler is None:
+        return contextlib.nullcontext()
+    return profiler.phase(name)
+
+
+#----------------------------------------------------------------------------------
+#
+#    ExcelSheet class
+#
+#----------------------------------------------------------------------------------
+
+class ExcelSheet():
+
+    """
+
+    Access Excel file for reading sheet and saving sheet with new formulas.
+    
+    Notes
+    -----
+    - Operates on CellStore *self.arr* with non-empty cells of Excel sheet, read only for the block at anchor. 
+    - Block of data at anchor is bounded by other blocks on sheet, see SheetLayout.
+    - Variables are held in Dataset *self.data*, *self.dataset* is its dataframe view.
+    - Uses MathModel class to update formulas.   
+    
+    Methods
+    -------
+    .insert_formulas() - populate cells in forecast periods with Excel-style formulas. 
+    .save() - update formulas and saves Excel file.
+
+    """
+    
+    def __init__(self, filepath, sheet = 1, anchor = 'A1', arr = None, cache = None, profiler = None, layout = None, 
+                 processes = None, chunk_size = None):
+        """
+        Inputs
+        ------
+        filepath : valid path to Excel file, .xls or .xlsx
+            sheet: string or integer >=1, representing sheet name or number starting at 1, defaults to first sheet 
+          anchor : string with A1 style reference, defaults to "A1"
+             arr : array or CellStore with cell values of the sheet, block at anchor is read from file if not given 
+           cache : FormulaCache to take formulas from and to skip writing unchanged file, not used if None 
+        profiler : Profiler to record time and memory of reading, parsing, formula generation and writing 
+          layout : SheetLayout of *arr*, built if not given 
+       processes : number of processes to generate formulas of large models, see MathModel.get_xl_formulas() 
+      chunk_size : if given, formulas are not kept in .arr but generated and written while saving, 
+                   *chunk_size* forecast periods at a time, cache is not used, see .iter_formula_ranges() 
+        """ 
+        
+        print(filepath)
+        self.source = {'path':filepath, 'sheet':sheet, 'anchor':anchor}
+        self.profiler = profiler
+        self.processes = processes
+        self.chunk_size = chunk_size
+        self.anchor_rowx, self.anchor_colx = to_rowcol(anchor, base = 0)
+        self.parse(arr, layout)
+        with _phase(profiler, 'model'):
+            self.model = MathModel(self.data, self.equations).set_xl_positioning(self.var_to_rows, anchor) 
+        
+        # update formulas on sheet, from cache if possible, streamed formulas are written on save only  
+        self.cache = cache if chunk_size is None else None
+        self.cache_hit = False
+        if chunk_size is not None:
+            return
+        if cache is not None:
+            self.cache_key = self.get_model_hash()
+            cells = cache.get(self.cache_key)
+            if cells is not None:
+                self.cache_hit = True
+                for rowx, colx, formula in cells:
+                    self.arr[rowx, colx] = formula
+        if not self.cache_hit:
+            with _phase(profiler, 'formulas'):
+                self.insert_formulas()
+            if cache is not None:
+                cache.put(self.cache_key, self.get_formula_cells())
+        
+    def parse(self, arr = None, layout = None):
+        """Read dataset, equations and variable rows from *arr* or from source file if not given."""
+        if arr is None:
+            with _phase(self.profiler, 'read'):
+                # cells outside of the block are not read and never written back
+                arr = get_cells_from_sheet(self.source['path'], self.source['sheet'], self.source['anchor'])
+        elif not isinstance(arr, CellStore):
+            arr = CellStore.from_array(arr)
+        self.arr = arr
+        # sheet as it was read, used to write only changed cells
+        self.source_arr = self.arr.copy()
+        with _phase(self.profiler, 'dataset'):
+            self.layout = layout or SheetLayout(self.arr, [self.source['anchor']])
+            row_stop, col_stop = self.layout.get_bounds(self.anchor_rowx, self.anchor_colx)
+            block = self.arr.to_array(self.anchor_rowx, self.anchor_colx, row_stop, col_stop)
+            self.data = Dataset.from_array(block, 0, 0)
+        with _phase(self.profiler, 'equations'):
+            self.equations = self.pop_equations()
+            self.check_dataset_after_equations()
+            self.var_to_rows = self.get_variable_locations_by_row()
+        return self
+        
+    @property
+    def dataset(self):
+        return self.data.to_dataframe()
+        
+    def refresh(self, arr = None):
+        """
+        Read sheet again from *arr* or from source file and regenerate formulas only 
+        for dependent variables affected by changed equations or variable rows. 
+        All formulas are regenerated if forecast periods changed. 
+        Returns list of regenerated variables.
+        """
+        previous_periods = self.data.periods, self.data.is_forecast
+        self.parse(arr)
+        self.model.dataset = self.data
+        affected = self.model.update(self.equations, self.var_to_rows)
+        if (self.data.periods, self.data.is_forecast) != previous_periods:
+            affected = list(self.model.order)
+        if self.chunk_size is None:
+            self.insert_formulas(affected)
+        return affected
+    
+    def check_dataset_after_equations(self):
+
+        labs = self.data.labels
+        # labels are unique if index has as many items as labels
+        dups = [] if len(self.data.index) == len(labs) else sorted(set(x for x in labs if labs.count(x) > 1))
+        if len(dups) > 0:
+            self.echo_diagnostics()
+            raise ValueError("Duplicate labels: " + ", ".join(dups))            
+    
+        if not 'is_forecast' in labs:
+            self.echo_diagnostics()
+            raise ValueError("Row 'is_forecast' not found in dataframe (possible reason - wrong anchor cell).")       
+                     
+    @staticmethod
+    def extract_dataframe(arr, anchor_rowx, anchor_colx):
+        """Return a part of 'self.arr' starting anchor cell as dataframe.""" 
+        import pandas as pd
+           
+        data = arr[anchor_rowx:,anchor_colx:]
+        return pd.DataFrame(data=data[1:,1:],    # values
+                           index=data[1:, 0],    # 1st column as index
+                         columns=data[0 ,1:])    # 1st row as the column names
+
+    def get_variable_locations_by_row(self):
+        """Return dictionary with variable row locations.""" 
+        labels = self.layout.get_labels(self.anchor_rowx, self.anchor_colx)
+        # +1 to rebase from 0  
+        return dict((label, rowx + 1) for label, rowx in labels.items() if label in self.data.index)
+        
+    def pop_equations(self):       
+        """Return list of strings containing equations. 
+           Also cleans out junk non-variable rows from self.data.""" 
+        equations = []        
+        junk = []
+                
+        for label in self.data.labels:
+            if "=" in label:
+                equations.append(label)
+                junk.append(label)
+            elif (" " in label.strip() 
+                  or label.startswith("#")
+                  or len(label) == 0):
+                junk.append(label)
+        self.data = self.data.drop(junk)
+        return equations       
+
+    def get_model_hash(self):
+        """Return hash of inputs that define formulas: equations, variable rows, anchor and forecast flags."""
+        inputs = [CACHE_VERSION, self.equations, sorted(self.var_to_rows.items()), 
+                  self.source['anchor'].upper(), self.data.forecast_positions.tolist()]
+        return hashlib.sha256(json.dumps(inputs).encode('utf-8')).hexdigest()
+        
+    def get_formula_cells(self):
+        """Return list of (rowx, colx, formula) for forecast cells of dependent variables."""
+        forecast_colx = [self.anchor_colx + 1 + int(t) for t in self.data.forecast_positions]
+        return [(self.var_to_rows[v] - 1, colx, self.arr[self.var_to_rows[v] - 1, colx]) 
+                for v in self.model.order if v in self.data.index for colx in forecast_colx]
+        
+    def is_written_in_cache(self, filepath, sheet):
+        """True if formulas are from cache and were written to *filepath* and *sheet* not changed since."""
+        return self.cache_hit and self.cache.is_written(self.cache_key, filepath, sheet)
+        
+    def insert_formulas(self, varnames = None):
+        """Populate formulas on array representing Excel sheet, only for *varnames* if given."""        
+        data = self.model.data
+        forecast_colx = self.anchor_colx + 1 + data.forecast_positions
+        for varname in self.model.get_xl_formulas(varnames, self.processes):
+            # whole row of forecast periods at once
+            self.arr[self.var_to_rows[varname] - 1, forecast_colx] = \
+                data.formulas[data.index[varname], data.forecast_positions]
+        return self
+        
+    def iter_formula_ranges(self, chunk_size = None):
+        """
+        Yield (rowx, colx, values) rectangles of formulas of *chunk_size* forecast periods 
+        at a time (defaults to .chunk_size or 1), generated by MathModel.iter_xl_formulas(). 
+        Formulas are neither kept in .arr nor in dataset.
+        """
+        return self.model.iter_formula_ranges(chunk_size or self.chunk_size or 1)
+        
+    def save_snapshot(self, path):
+        """Write parsed model and its place on sheet to binary snapshot file, see ModelSnapshot."""
+        ModelSnapshot.from_sheet(self).save(path)
+        return self
+
+    def save(self, filepath=None, sheet=None, r1c1=False, backend='auto', full=False):
+        """
+        Write sheet with formulas to *filepath* and *sheet*, defaults to source file and sheet.
+        
+        On source sheet only cells changed since reading are written, coalesced into 
+        rectangular ranges. Whole sheet is written to other sheets or if *full* is True.
+        With r1c1=True each equation row is written as a single R1C1 formula across 
+        forecast periods. *backend* is one of WRITER_BACKENDS.
+        """
+        if not filepath:
+            filepath = self.source['path']            
+        if not sheet:
+            sheet = self.source['sheet']
+        self.target = {'path':filepath, 'sheet':sheet}
+        to_source = (filepath, sheet) == (self.source['path'], self.source['sheet'])
+ 
+        if to_source and not full and self.is_written_in_cache(filepath, sheet):
+            return self
+        
+        with _phase(self.profiler, 'write'):
+            writer = get_writer(filepath, backend)
+            self.write(writer, sheet, r1c1, full or not to_source)
+            writer.save()
+        
+        if to_source:
+            self.source_arr = self.arr.copy()
+        if self.cache is not None:
+            self.cache.mark_written(self.cache_key, filepath, sheet)
+        return self
+
+    def write(self, writer, sheet, r1c1=False, full=False):
+        """
+        Write cells changed since reading or all non-empty cells read if *full* is True with *writer*, 
+        without saving. Cells that were not read are not written. Formulas are streamed to *writer* 
+        if .chunk_size is set.
+        """
+        if full:
+            for rowx, colx, values in self.arr.get_ranges():
+                writer.write_range(sheet, rowx, colx, values)
+        elif not r1c1:
+            for rowx, colx, values in get_changed_ranges(self.source_arr, self.arr):
+                writer.write_range(sheet, rowx, colx, values)
+        if r1c1:
+            for row, first_col, last_col, formula in self.model.get_r1c1_ranges():
+                writer.write_r1c1_range(sheet, row, first_col, last_col, formula)
+        elif self.chunk_size is not None:
+            for rowx, colx, values in self.iter_formula_ranges():
+                writer.write_range(sheet, rowx, colx, values)
+        return self
+        
+    def echo(self, profile = True):
+        print("\nFile:\n    " + self.target['path'])
+        print(  "Sheet:\n    " + str(self.target['sheet'])) 
+        if self.cache_hit:
+            print("Formulas from cache")
+        print("Updated formulas:")
+        eqs = ["    " + k + " = " + v  for k, v in self.model.equations.items()]
+        for e in eqs:
+            print(e)
+        if profile and self.profiler is not None:
+            self.profiler.echo()
+        return self
+        
+    def echo_diagnostics(self):
+        print("File:\n    ", self.source['path'])
+        print("Sheet:\n    ", str(self.source['sheet']))            
+        print("Anchor row and column:\n    ", self.anchor_rowx, self.anchor_colx)             
+        print("Dataset labels:\n    ", self.data.labels) 
+    
+    
+        
+class ExcelBook():
+    """
+    Access Excel file once for several sheets and anchors. 
+    
+    Workbook is parsed once, ExcelSheet objects are created for each 
+    (sheet, anchor) pair and all formula updates are written in one save. 
+    
+    Example
+    -------
+    book = ExcelBook("test1.xls")
+    book.sheet(1, "A1")
+    book.sheet(2, "B3")
+    book.save() 
+    
+    Several blocks on one sheet are bounded by each other: 
+    book.blocks(1, ["A1", "A20"]) or book.blocks(1) to find blocks by 'is_forecast' labels
+    
+    """
+    
+    def __init__(self, filepath, cache = None, profiler = None, processes = None, chunk_size = None):
+        self.path = filepath
+        self.reader = WorkbookReader(filepath)
+        self.cache = cache
+        self.profiler = profiler
+        self.processes = processes
+        self.chunk_size = chunk_size
+        self.sheets = []
+        # CellStore of whole sheets read from file, shared by all anchors on sheet 
+        self._cells = {}
+    
+    def _get_cells(self, sheet):
+        if sheet not in self._cells:
+            with _phase(self.profiler, 'read'):
+                self._cells[sheet] = self.reader.get_cells(sheet)
+        return self._cells[sheet]
+    
+    def sheet(self, sheet = 1, anchor = 'A1', layout = None):
+        """Return ExcelSheet for *sheet* and *anchor*, it will be saved with .save()"""
+        xl = ExcelSheet(self.path, sheet, anchor, arr = self._get_cells(sheet).copy(), 
+                        cache = self.cache, profiler = self.profiler, layout = layout, 
+                        processes = self.processes, chunk_size = self.chunk_size)
+        self.sheets.append(xl)
+        return xl
+        
+    def blocks(self, sheet = 1, anchors = None):
+        """
+        Return list of ExcelSheet for blocks on *sheet* at *anchors* (A1 references), 
+        blocks are found by 'is_forecast' labels if *anchors* is None, see SheetLayout. 
+        """
+        layout = SheetLayout(self._get_cells(sheet), anchors)
+        if not layout.anchors:
+            raise ValueError("No data blocks found on sheet: " + str(sheet))
+        return [self.sheet(sheet, anchor, layout) for anchor in layout.get_anchors()]
+        
+    def save(self, r1c1=False, backend='auto'):
+        """Write changed cells of all sheets in one save, file is not written if all sheets are written according to cache."""
+        self.reader.close()
+        for xl in self.sheets:
+            xl.target = {'path':self.path, 'sheet':xl.source['sheet']}
+        to_write = [xl for xl in self.sheets if not xl.is_written_in_cache(self.path, xl.source['sheet'])]
+        if not to_write:
+            return self
+        with _phase(self.profiler, 'write'):
+            writer = get_writer(self.path, backend)
+            for xl in to_write:
+                xl.write(writer, xl.source['sheet'], r1c1)
+            writer.save()
+        for xl in self.sheets:
+            xl.source_arr = xl.arr.copy()
+            if xl.cache is not None:
+                xl.cache.mark_written(xl.cache_key, self.path, xl.source['sheet'])
+        return self
+        
+    def echo(self):
+        for xl in self.sheets:
+            xl.echo(profile = False)
+        if self.profiler is not None:
+            self.profiler.echo()
+        return self
+        
+
+#----------------------------------------------------------------------------------
+#
+#    Block assembler
+#
+#----------------------------------------------------------------------------------
+
+class BlockAssembler():
+    """
+    Lay out model sheet from separate blocks in memory and write it to a new workbook at once.
+    
+    Sheet at anchor, labels in anchor column:
+        periods row 
+        'is_forecast' row
+        '# data' block - variables of dataset and dependent variables, with formulas in forecast periods 
+        '# controls' block - other control variables 
+        '# equations' block - one equation per row
+    Titles of blocks start with '#', they are skipped when sheet is read by ExcelSheet.
+    
+    Parameters
+    ----------
+    equations : list of equation strings
+    data : Dataset or dataframe (periods in index, variables in columns) with historic values
+    controls : Dataset or dataframe with control variables, usually in forecast periods, values 
+               override *data* values
+    anchor : A1 reference of upper-left cell of the block
+    
+    If 'is_forecast' is in neither *data* nor *controls*, periods of *data* are historic and 
+    other periods of *controls* are forecast.
+    
+    Methods
+    -------
+    .from_model(model) - assembler for MathModel, e.g. ExcelSheet(...).model  
+    .get_dataset() - Dataset with all variables and periods
+    .get_cells() - CellStore with sheet cells and formulas 
+    .save(filepath, sheet, backend) - write new workbook with one sheet 
+    
+    """
+    
+    def __init__(self, equations, data, controls = None, anchor = 'A1'):
+        self.equations = Equations(equations).dict
+        self.data = self._to_dataset(data)
+        self.controls = self._to_dataset(controls) if controls is not None else Dataset([], self.data.periods, [])
+        self.anchor = anchor
+        
+    @staticmethod
+    def _to_dataset(data):
+        return data if isinstance(data, Dataset) else Dataset.from_dataframe(data)
+        
+    @classmethod
+    def from_model(cls, model, anchor = 'A1'):
+        """Assembler with dependent variables of *model* in data block and its controls in controls block."""
+        dependents = set(model.equations)
+        controls = [v for v in model.data.labels if v != 'is_forecast' and v not in dependents 
+                    and any(v in refs for refs in model.references.values())]
+        equations = [varname + ' = ' + equation for varname, equation in model.equations.items()]
+        return cls(equations, model.data.drop(controls), 
+                   model.data.drop([v for v in model.data.labels if v not in controls]), anchor)
+        
+    def get_blocks(self):
+        """Return variables of data and controls blocks."""
+        data_block = [v for v in self.data.labels if v != 'is_forecast']
+        data_block += [v for v in self.equations if v not in data_block]
+        control_block = [v for v in self.controls.labels if v != 'is_forecast' and v not in data_block]
+        return data_block, control_block
+        
+    def get_dataset(self):
+        """Return Dataset with 'is_forecast' and all variables of blocks in all periods."""
+        periods = list(OrderedDict.fromkeys(self.data.periods + self.controls.periods))
+        data_block, control_block = self.get_blocks()
+        labels = ['is_forecast'] + data_block + control_block
+        index = dict((label, i) for i, label in enumerate(labels))
+        values = np.empty((len(labels), len(periods)), dtype=object)
+        values.fill('')
+        # controls come second and override data, nan is empty cell 
+        for dataset in [self.data, self.controls]:
+            columns = [periods.index(p) for p in dataset.periods]
+            for label, rowx in dataset.index.items():
+                for colx, value in zip(columns, dataset.values[rowx]):
+                    if not _is_empty(value) and value == value:
+                        values[index[label], colx] = value
+        if 'is_forecast' not in self.data.index and 'is_forecast' not in self.controls.index:
+            historic = set(self.data.periods)
+            values[0] = [0 if p in historic else 1 for p in periods]
+        return Dataset(labels, periods, values)
+        
+    def get_cells(self):
+        """Return CellStore with model sheet: labels, values, formulas in forecast periods and equations."""
+        dataset = self.get_dataset()
+        data_block, control_block = self.get_blocks()
+        equations = [varname + ' = ' + equation for varname, equation in self.equations.items()]
+        column = ['is_forecast', '# data'] + data_block + ['# controls'] + control_block + ['# equations'] + equations
+        anchor_rowx, anchor_colx = to_rowcol(self.anchor, base = 0)
+        # +1 for periods row, +1 to rebase from 0 
+        var_to_rows = dict((label, anchor_rowx + 2 + i) for i, label in enumerate(column) if label in dataset.index)
+        model = MathModel(dataset, equations).set_xl_positioning(var_to_rows, self.anchor)
+        model.get_xl_formulas()
+        
+        cells = CellStore()
+        cells[anchor_rowx, anchor_colx + 1 + np.arange(len(dataset.periods))] = dataset.periods
+        for i, label in enumerate(column):
+            rowx = anchor_rowx + 1 + i
+            cells[rowx, anchor_colx] = label
+            if label in dataset.index:
+                values = model.data.values[dataset.index[label]]
+                formulas = model.data.formulas[dataset.index[label]]
+                cells[rowx, anchor_colx + 1 + np.arange(len(values))] = np.where(formulas != None, formulas, values)
+        return cells
+        
+    def save(self, filepath, sheet = 'model', backend = 'auto'):
+        """Write new workbook *filepath* with model on *sheet* in one bulk write, existing file is replaced."""
+        write_workbook(filepath, {sheet: self.get_cells().to_array()}, backend)
+        return self
+
+
+#----------------------------------------------------------------------------------
+#
+#    Batch processing
+#
+#----------------------------------------------------------------------------------
+
+def _to_sheet(sheet):
+    """Sheet index as integer if possible, sheet name otherwise."""
+    try:
+        return int(sheet)
+    except ValueError:
+        return sheet
+
+def read_manifest(manifest_path, sheet = 1, anchor = 'A1'):
+    """
+    Return list of jobs from manifest file. Each line is 'file, sheet, anchor', 
+    sheet and anchor are optional. Relative paths are based at manifest file directory. 
+    Empty lines and lines starting with '#' are skipped.
+    """
+    base_dir = os.path.dirname(os.path.abspath(manifest_path))
+    jobs = []
+    with open(manifest_path) as f:
+        for line in f:
+            if not line.strip() or line.strip().startswith('#'):
+                continue
+            fields = [x.strip() for x in line.split(',')] + ['', '']
+            path, job_sheet, job_anchor = fields[:3]
+            jobs.append({'path': os.path.join(base_dir, path), 
+                         'sheet': _to_sheet(job_sheet) if job_sheet else sheet, 
+                         'anchor': job_anchor or anchor})
+    return jobs
+
+def glob_jobs(patterns, sheet = 1, anchor = 'A1'):
+    """Return list of jobs for files matching *patterns*. Patterns without matches are kept as is to report them as failed."""
+    jobs = []
+    for pattern in patterns:
+        paths = sorted(glob.glob(pattern, recursive=True)) or [pattern]
+        jobs.extend({'path': path, 'sheet': sheet, 'anchor': anchor} for path in paths)
+    return jobs
+
+def process_workbook(path, jobs, save_kwargs, cache = None):
+    """
+    Read sheet for each job on same file with ExcelBook and save them at once. Runs in worker process.
+    Returns list of jobs updated with 'status', 'error', 'seconds' and 'output' (printed text).
+    """
+    results = []
+    book = ExcelBook(path, cache)
+    for job in jobs:
+        start = time.perf_counter()
+        result = dict(job, status='ok', error='')
+        output = io.StringIO()
+        try:
+            with contextlib.redirect_stdout(output):
+                book.sheet(job['sheet'], job['anchor'])
+        except Exception as e:
+            result['status'] = 'failed'
+            result['error'] = type(e).__name__ + ': ' + str(e)
+        result['seconds'] = time.perf_counter() - start
+        result['output'] = output.getvalue()
+        results.append(result)
+        
+    # all sheets of the file are written in one save, its time is added to each sheet  
+    start = time.perf_counter()
+    try:
+        book.save(**save_kwargs)
+    except Exception as e:
+        for result in results:
+            if result['status'] == 'ok':
+                result['status'] = 'failed'
+                result['error'] = type(e).__name__ + ': ' + str(e)
+    save_seconds = time.perf_counter() - start
+    for result in results:
+        result['seconds'] += save_seconds
+    return results
+
+def _failed_results(jobs, e):
+    """Results of *jobs* lost with their worker, e.g. when worker process crashed."""
+    return [dict(job, status='failed', error=type(e).__name__ + ': ' + str(e), seconds=0.0, output='') 
+            for job in jobs]
+
+def run_batch(jobs, processes = None, echo = True, cache = None, **save_kwargs):
+    """
+    Process *jobs* (dictionaries with 'path', 'sheet', 'anchor') in a pool of *processes*.
+    Jobs on same file are processed in one worker one after another, so that a file is 
+    never written by two processes. Failed jobs do not stop the rest. 
+    *cache* is FormulaCache shared by workers or None.
+    Returns list of results from process_workbook().
+    """
+    by_path = OrderedDict()
+    for job in jobs:
+        by_path.setdefault(os.path.abspath(job['path']), []).append(job)
+    
+    def report(results):
+        if echo:
+            for r in results:
+                print("%-6s %8.3f s  %s %s %s %s" % (r['status'], r['seconds'], r['path'], 
+                                                     r['sheet'], r['anchor'], r['error']))
+        return results
+    
+    results = []
+    if processes == 1 or len(by_path) <= 1:
+        for path, path_jobs in by_path.items():
+            results.extend(report(process_workbook(path, path_jobs, save_kwargs, cache)))
+    else:
+        import concurrent.futures
+        with concurrent.futures.ProcessPoolExecutor(max_workers = processes) as pool:
+            futures = dict((pool.submit(process_workbook, path, path_jobs, save_kwargs, cache), path_jobs) 
+                           for path, path_jobs in by_path.items())
+            for future in concurrent.futures.as_completed(futures):
+                # a crashed worker breaks the pool, jobs of each pending file are reported as failed
+                try:
+                    path_results = future.result()
+                except Exception as e:
+                    path_results = _failed_results(futures[future], e)
+                results.extend(report(path_results))
+    return results
+
+def batch_cli(argv = None):
+    """Command line interface to run_batch(), returns exit code: 0 if all files processed, 1 otherwise."""
+    
+    parser = argparse.ArgumentParser(prog='xlmodel.py batch',
+                                     description='Update formulas in many files using a pool of processes',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('patterns', nargs='*',             help='filenames or glob patterns, e.g. examples/*.xls')
+    parser.add_argument('--manifest',                      help='file with lines: filename, sheet, anchor')
+    parser.add_argument('--sheet', default=1,              help='sheet name or sheet index starting at 1, for patterns')
+    parser.add_argument('--anchor', default='A1',          help='reference to upper-left corner of data block, for patterns')
+    parser.add_argument('-j', '--processes', type=int, default=os.cpu_count(), 
+                                                           help='number of worker processes')
+    parser.add_argument('--r1c1', action='store_true',     help='write one R1C1 formula per equation row')
+    parser.add_argument('--backend', default='auto', choices=WRITER_BACKENDS, 
+                                                           help='write through Excel (xlwings) or directly to file')
+    parser.add_argument('--no-cache', action='store_true', help='do not use formula cache in ' + get_default_cache_dir())
+    args = parser.parse_args(argv)
+    
+    sheet = _to_sheet(args.sheet)
+    jobs = glob_jobs(args.patterns, sheet, args.anchor)
+    if args.manifest:
+        jobs.extend(read_manifest(args.manifest, sheet, args.anchor))
+    if not jobs:
+        parser.error("no files given")
+        
+    start = time.perf_counter()
+    cache = None if args.no_cache else FormulaCache()
+    results = run_batch(jobs, args.processes, cache=cache, r1c1=args.r1c1, backend=args.backend)
+    failed = [r for r in results if r['status'] != 'ok']
+    print("\nProcessed %d, failed %d in %.3f s" % (len(results), len(failed), time.perf_counter() - start))
+    return 1 if failed else 0
+    
+    
+#----------------------------------------------------------------------------------
+#
+#    Watch mode
+#
+#----------------------------------------------------------------------------------
+
+class Watcher():
+    """
+    Poll workbooks for changes and update formulas on sheets where equations, 
+    labels or forecast periods changed. Model hash of each sheet is kept in memory 
+    between polls, so that edits of data values only do not cause writing. 
+    Runs in one long-lived process, modules are imported once.
+    
+    Parameters
+    ----------
+    targets : list of filenames, folders or glob patterns, folders are watched for .xls and .xlsx files 
+    sheet, anchor : sheet and anchor used for all targets
+    manifest : file with lines 'filename, sheet, anchor', optional
+    delay : seconds a changed file must stay unchanged before it is read, joins rapid saves
+    save_kwargs : passed to ExcelBook.save()
+    
+    Methods
+    -------
+    .get_jobs() - list of jobs for existing files
+    .poll() - process files changed since last poll, return list of results 
+    .run(interval) - poll until interrupted
+    
+    """
+    
+    def __init__(self, targets, sheet = 1, anchor = 'A1', manifest = None, delay = 0.5, **save_kwargs):
+        self.targets = targets
+        self.sheet = sheet
+        self.anchor = anchor
+        self.manifest = manifest
+        self.delay = delay
+        self.save_kwargs = save_kwargs
+        # file stamp seen last, including stamp after own write  
+        self.stamps = {}
+        # model hash by (path, sheet, anchor) at last update 
+        self.hashes = {}
+        
+    def get_jobs(self):
+        patterns = [os.path.join(t, '*.xls*') if os.path.isdir(t) else t for t in self.targets]
+        jobs = glob_jobs(patterns, self.sheet, self.anchor)
+        if self.manifest:
+            jobs.extend(read_manifest(self.manifest, self.sheet, self.anchor))
+        # skip missing files and lock files Excel keeps next to open workbooks 
+        return [job for job in jobs if os.path.isfile(job['path']) 
+                                   and not os.path.basename(job['path']).startswith('~$')]
+                                   
+    def _stamps(self, paths):
+        stamps = {}
+        for path in paths:
+            try:
+                stamps[path] = get_file_stamp(path)
+            except OSError:
+                pass
+        return stamps
+        
+    def _wait_until_stable(self, stamps):
+        while True:
+            time.sleep(self.delay)
+            current = self._stamps(stamps)
+            if current == stamps:
+                return stamps
+            stamps = current
+        
+    def poll(self):
+        by_path = OrderedDict()
+        for job in self.get_jobs():
+            by_path.setdefault(os.path.abspath(job['path']), []).append(job)
+        changed = {path: stamp for path, stamp in self._stamps(by_path).items() if stamp != self.stamps.get(path)}
+        if not changed:
+            return []
+        if self.delay:
+            changed = self._wait_until_stable(changed)
+        results = []
+        for path in changed:
+            results.extend(self.process(path, by_path[path]))
+        return results
+        
+    def process(self, path, jobs):
+        """Update sheets of one file where model hash changed, return results with status 'updated', 'unchanged' or 'failed'."""
+        results = []
+        updated = []
+        try:
+            book = ExcelBook(path)
+        except Exception as e:
+            self.stamps[path] = get_file_stamp(path)
+            return [dict(job, status='failed', error=type(e).__name__ + ': ' + str(e)) for job in jobs]
+        for job in jobs:
+            key = (path, job['sheet'], job['anchor'])
+            result = dict(job, status='unchanged', error='')
+            try:
+                with contextlib.redirect_stdout(io.StringIO()):
+                    xl = book.sheet(job['sheet'], job['anchor'])
+                model_hash = xl.get_model_hash()
+                if self.hashes.get(key) != model_hash:
+                    result['status'] = 'updated'
+                    updated.append((key, model_hash))
+                else:
+                    book.sheets.remove(xl)
+            except Exception as e:
+                result['status'] = 'failed'
+                result['error'] = type(e).__name__ + ': ' + str(e)
+            results.append(result)
+            
+        if updated:
+            try:
+                book.save(**self.save_kwargs)
+                self.hashes.update(updated)
+            except Exception as e:
+                for result in results:
+                    if result['status'] == 'updated':
+                        result['status'] = 'failed'
+                        result['error'] = type(e).__name__ + ': ' + str(e)
+        else:
+            book.reader.close()
+        # own write changes the file, its stamp is taken after saving 
+        self.stamps[path] = get_file_stamp(path)
+        return results
+        
+    def run(self, interval = 1.0, echo = True):
+        try:
+            while True:
+                for r in self.poll():
+                    if echo:
+                        print("%-9s %s %s %s %s" % (r['status'], r['path'], r['sheet'], r['anchor'], r['error']))
+                        sys.stdout.flush()
+                time.sleep(interval)
+        except KeyboardInterrupt:
+            pass
+        
+def watch_cli(argv = None):
+    """Command line interface to Watcher.run()."""
+    
+    parser = argparse.ArgumentParser(prog='xlmodel.py watch',
+                                     description='Update formulas when equations or labels change in watched files',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('targets', nargs='*',              help='filenames, folders or glob patterns, e.g. examples/')
+    parser.add_argument('--manifest',                      help='file with lines: filename, sheet, anchor')
+    parser.add_argument('--sheet', default=1,              help='sheet name or sheet index starting at 1, for targets')
+    parser.add_argument('--anchor', default='A1',          help='reference to upper-left corner of data block, for targets')
+    parser.add_argument('--interval', type=float, default=1.0, help='seconds between checks')
+    parser.add_argument('--delay', type=float, default=0.5, help='seconds a file must stay unchanged before reading')
+    parser.add_argument('--r1c1', action='store_true',     help='write one R1C1 formula per equation row')
+    parser.add_argument('--backend', default='auto', choices=WRITER_BACKENDS, 
+                                                           help='write through Excel (xlwings) or directly to file')
+    args = parser.parse_args(argv)
+    if not args.targets and not args.manifest:
+        parser.error("no files given")
+    
+    watcher = Watcher(args.targets, _to_sheet(args.sheet), args.anchor, args.manifest, args.delay, 
+                      r1c1=args.r1c1, backend=args.backend)
+    print("Watching %s, press Ctrl+C to stop" % ', '.join(args.targets + ([args.manifest] if args.manifest else [])))
+    watcher.run(args.interval)
+    return 0
+    
+    
+#----------------------------------------------------------------------------------
+#
+#    Formula service
+#
+#----------------------------------------------------------------------------------
+
+class FormulaService():
+    """
+    Formula generation over HTTP/JSON on localhost, served with asyncio. 
+    
+    POST /formulas with JSON body:
+        {"equations": ["y = y[t-1] * rog"], "var_to_rows": {"is_forecast": 2, "y": 3, "rog": 4},
+         "anchor": "A1", "is_forecast": [0, 0, 1]}
+    returns formulas of dependent variables for each period, null in historic periods:
+        {"order": ["y"], "formulas": {"y": [null, null, "=C3*D4"]}}
+    GET /health returns number of models kept.
+    
+    Models are kept in LRU of *max_models* entries keyed by request, so repeated requests 
+    skip parsing. Formulas are generated in a thread pool, requests are handled concurrently.
+    
+    Methods
+    -------
+    .get_formulas(request) - response dictionary for request dictionary 
+    .serve(host, port) - coroutine serving until cancelled
+    
+    """
+    
+    def __init__(self, max_models = 128, workers = None):
+        import concurrent.futures
+        import threading
+        self.max_models = max_models
+        # own pool, so that formula generation does not wait behind other users of the default executor
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers = workers)
+        self.models = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        
+    @staticmethod
+    def _key(request):
+        for field in ['equations', 'var_to_rows', 'is_forecast']:
+            if field not in request:
+                raise ValueError("Field required: " + field)
+        return json.dumps([request['equations'], sorted(request['var_to_rows'].items()), 
+                           request.get('anchor', 'A1').upper(), request['is_forecast']])
+        
+    @staticmethod
+    def _make_model(request):
+        var_to_rows = request['var_to_rows']
+        is_forecast = request['is_forecast']
+        labels = ['is_forecast'] + [v for v in var_to_rows if v != 'is_forecast']
+        values = np.full((len(labels), len(is_forecast)), '', dtype=object)
+        values[0] = is_forecast
+        model = MathModel(Dataset(labels, range(len(is_forecast)), values), request['equations'])
+        model.set_xl_positioning(var_to_rows, request.get('anchor', 'A1'))
+        model.get_xl_formulas()
+        return model
+    
+    def get_model(self, request):
+        key = self._key(request)
+        with self._lock:
+            model = self.models.get(key)
+            if model is not None:
+                self.models.move_to_end(key)
+                self.hits += 1
+                return model
+        model = self._make_model(request)
+        with self._lock:
+            self.misses += 1
+            self.models[key] = model
+            while len(self.models) > self.max_models:
+                self.models.popitem(last = False)
+        return model
+        
+    def get_formulas(self, request):
+        model = self.get_model(request)
+        data = model.data
+        return {'order': model.order,
+                'formulas': dict((v, data.formulas[data.index[v]].tolist()) for v in model.order if v in data.index)}
+        
+    def get_health(self):
+        return {'status': 'ok', 'models': len(self.models), 'hits': self.hits, 'misses': self.misses}
+    
+    async def _respond(self, method, path, body):
+        import asyncio
+        if path == '/health' and method == 'GET':
+            return 200, self.get_health()
+        if path != '/formulas':
+            return 404, {'error': 'Not found: ' + path}
+        if method != 'POST':
+            return 405, {'error': 'Use POST for ' + path}
+        try:
+            request = json.loads(body.decode('utf-8'))
+            loop = asyncio.get_running_loop()
+            return 200, await loop.run_in_executor(self.executor, self.get_formulas, request)
+        except (ValueError, KeyError, TypeError, AttributeError) as e:
+            return 400, {'error': type(e).__name__ + ': ' + str(e)}
+    
+    async def handle(self, reader, writer):
+        """Serve HTTP/1.1 requests on one connection, kept alive unless client closes it."""
+        import asyncio
+        reasons = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed'}
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line.strip():
+                    break
+                method, path = request_line.decode('latin-1').split()[:2]
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if not line.strip():
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get('content-length', 0)))
+                status, result = await self._respond(method, path, body)
+                payload = json.dumps(result).encode('utf-8')
+                close = headers.get('connection', '').lower() == 'close'
+                writer.write(('HTTP/1.1 %d %s\r\nContent-Type: application/json\r\n'
+                              'Content-Length: %d\r\nConnection: %s\r\n\r\n' 
+                              % (status, reasons[status], len(payload), 'close' if close else 'keep-alive')
+                              ).encode('latin-1') + payload)
+                await writer.drain()
+                if close:
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+            pass
+        finally:
+            writer.close()
+            
+    async def serve(self, host = '127.0.0.1', port = 8765, ready = None):
+        """Serve until cancelled, *ready* is called with bound port when server accepts connections."""
+        import asyncio
+        server = await asyncio.start_server(self.handle, host, port)
+        try:
+            async with server:
+                if ready is not None:
+                    ready(server.sockets[0].getsockname()[1])
+                await server.serve_forever()
+        finally:
+            self.executor.shutdown(wait = False)
+            
+def serve_cli(argv = None):
+    """Command line interface to FormulaService.serve()."""
+    import asyncio
+    
+    parser = argparse.ArgumentParser(prog='xlmodel.py serve',
+                                     description='Serve formula generation over HTTP/JSON, POST /formulas',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--host', default='127.0.0.1',     help='address to listen on')
+    parser.add_argument('--port', type=int, default=8765,  help='port to listen on')
+    parser.add_argument('--max-models', type=int, default=128, help='number of models kept in memory')
+    args = parser.parse_args(argv)
+    
+    service = FormulaService(args.max_models)
+    ready = lambda port: print("Serving on http://%s:%d/formulas, press Ctrl+C to stop" % (args.host, port))
+    try:
+        asyncio.run(service.serve(args.host, args.port, ready))
+    except KeyboardInterrupt:
+        pass
+    return 0
+    
+    
+def cli():
+    """
+    Command line interface to ExcelSheet(filepath, sheet, anchor).save(), 
+    'batch', 'watch' and 'serve' subcommands run batch_cli(), watch_cli() and serve_cli()
+    """
+    
+    if sys.argv[1:2] == ['batch']:
+        sys.exit(batch_cli(sys.argv[2:]))
+    if sys.argv[1:2] == ['watch']:
+        sys.exit(watch_cli(sys.argv[2:]))
+    if sys.argv[1:2] == ['serve']:
+        sys.exit(serve_cli(sys.argv[2:]))
+        
+    parser = argparse.ArgumentParser(description='Command line interface to XlSheet(filename, sheet, anchor).save()',
+                                     epilog="Use 'batch' subcommand to process many files, see 'batch -h', "
+                                            "'watch' subcommand to update files on change, see 'watch -h', "
+                                            "'serve' subcommand to generate formulas over HTTP, see 'serve -h'",
+                                                           formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('filename', nargs='?',             help='filename or path to .xls or .xlsx file, or to ' 
+                                                                + SNAPSHOT_EXTENSION + ' snapshot of parsed model')
+    parser.add_argument('sheet',  nargs='?', default=argparse.SUPPRESS, help='sheet name or sheet index starting at 1, default 1 '
+                                                                'or sheet stored in snapshot')
+    parser.add_argument('anchor', nargs='?', default=argparse.SUPPRESS, help="reference to upper-left corner of data block, "
+                                                                "comma-separated references of several blocks or 'auto', "
+                                                                "default A1, not used with snapshot")
+    parser.add_argument('--r1c1', action='store_true',     help='write one R1C1 formula per equation row')
+    parser.add_argument('--backend', default='auto', choices=WRITER_BACKENDS, 
+                                                           help='write through Excel (xlwings) or directly to file')
+    parser.add_argument('--no-cache', action='store_true', help='do not use formula cache in ' + get_default_cache_dir())
+    parser.add_argument('--clear-cache', action='store_true', help='remove all entries from formula cache')
+    parser.add_argument('-j', '--processes', type=int,     help='generate formulas of large models in this many processes')
+    parser.add_argument('--chunk-size', type=int,          help='generate and write formulas this many forecast periods at a time')
+    parser.add_argument('--profile', nargs='?', const='-', metavar='FILE', 
+                                                           help='write time, calls and peak memory of phases as JSON to FILE, or to stdout '
+                                                                'with other output moved to stderr')
+    parser.add_argument('--save-snapshot', metavar='FILE', help='write parsed model to binary snapshot FILE for fast reload')
     
     # get arguements
     args = parser.parse_args()
+    if args.clear_cache:
+        FormulaCache().clear()
+        if args.filename is None:
+            return None
+    if args.filename is None:
+        parser.error("filename is required")
     filename = args.filename
-    anchor = args.anchor
-    try:
-        sheet = int(args.sheet)
-    except ValueError:
-        sheet = args.sheet
+    # sheet and anchor are in args only if given, snapshot has its own 
+    given_sheet, given_anchor = getattr(args, 'sheet', None), getattr(args, 'anchor', None)
+    anchor = given_anchor or 'A1'
+    sheet = _to_sheet(given_sheet or 1)
+    cache = None if args.no_cache else FormulaCache()
+    profiler = Profiler() if args.profile else None
    
-    xl = ExcelSheet(filename, sheet, anchor)
-    xl.save().echo()
+    # JSON profile on stdout is the only output there, text of the run goes to stderr 
+    output = contextlib.redirect_stdout(sys.stderr) if args.profile == '-' else contextlib.nullcontext()
+    with output:
+        if filename.lower().endswith(SNAPSHOT_EXTENSION):
+            # formulas of parsed model go to workbook of snapshot, workbook is not read
+            if given_anchor is not None:
+                parser.error("anchor is stored in snapshot, give only sheet to write to other sheet")
+            with _phase(profiler, 'read'):
+                xl = ModelSnapshot.load(filename)
+            with _phase(profiler, 'write'):
+                xl.write_formulas(sheet = None if given_sheet is None else sheet, backend = args.backend, 
+                                  chunk_size = args.chunk_size or 100)
+            xl.echo()
+        elif anchor.lower() == 'auto' or ',' in anchor:
+            if args.save_snapshot:
+                parser.error("--save-snapshot needs a single anchor")
+            xl = ExcelBook(filename, cache = cache, profiler = profiler, processes = args.processes, 
+                           chunk_size = args.chunk_size)
+            xl.blocks(sheet, None if anchor.lower() == 'auto' else [a.strip() for a in anchor.split(',')])
+            xl.save(r1c1=args.r1c1, backend=args.backend)
+            for sh in xl.sheets:
+                sh.echo(profile = False)
+        else:
+            xl = ExcelSheet(filename, sheet, anchor, cache = cache, profiler = profiler, processes = args.processes, 
+                            chunk_size = args.chunk_size)
+            xl.save(r1c1=args.r1c1, backend=args.backend).echo(profile = False)
+            if args.save_snapshot:
+                xl.save_snapshot(args.save_snapshot)
+    if profiler is not None:
+        text = json.dumps(profiler.to_dict(), indent=2)
+        if args.profile == '-':
+            print(text)
+        else:
+            with open(args.profile, 'w') as f:
+                f.write(text)
     return xl
     
 if __name__ == "__main__":